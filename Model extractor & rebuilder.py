@@ -1,29 +1,20 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import struct
 import os
-
-# Define constants
-MAGIC = b'CAR4'
-OFFSET_SECTION_SIZE = 10 * 4
-ASSET_NAMES = [
-    "CarInfo", "CarCollision", "MainModel", "MainModelColorPatch",
-    "WheelModel", "WheelColorPatch", "WingModelSet",
-    "TireModel_0", "TireModel_1", "DriverModel"
-]
-DEFAULT_EXTENSIONS = {
-    "MainModelColorPatch": ".pat",
-    "WheelColorPatch": ".pat"
-}
+from car4 import MAGIC, HEADER_SIZE, ASSET_NAMES, DEFAULT_EXTENSIONS, extract_offsets, read_assets, write_model
+from extract_all import bulk_extract
+from instrument import configure_from_env, logger
+from worker import Worker
 
 class FileExtractor:
     def __init__(self, root):
         self.root = root
         self.root.title("Model File Extractor and Rebuilder")
-        self.root.geometry("400x100")
+        self.root.geometry("400x150")
         
         self.offsets = []
-        self.file_data = None
+        self.header = None
+        self.worker = Worker(root)
 
         self.select_file_btn = tk.Button(root, text="Extract Model", command=self.extractor_load_file)
         self.select_file_btn.pack(pady=10)
@@ -31,20 +22,25 @@ class FileExtractor:
         self.rebuild_file_btn = tk.Button(root, text="Rebuild Model", command=self.rebuilder_load_file)
         self.rebuild_file_btn.pack(pady=10)
 
+        self.extract_folder_btn = tk.Button(root, text="Extract Folder", command=self.extract_folder)
+        self.extract_folder_btn.pack(pady=10)
+
     def extractor_load_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("All files", "*.*")])
         if not file_path:
             return
         
+        # Assets are read from the file when extracted, so only the header is needed here
         with open(file_path, "rb") as f:
-            self.file_data = f.read()
+            self.header = f.read(HEADER_SIZE)
         
-        if self.file_data[:4] != MAGIC:
+        if self.header[:4] != MAGIC:
             messagebox.showerror("Error", "Invalid model file format!")
             return
 
-        print (f"Extractor:  Model file loaded")
+        logger.info("Extractor: Model file loaded: %s, offsets %s", file_path, extract_offsets(self.header))
             
+        self.file_path = file_path
         self.extract_offsets()
         self.show_asset_selection()
         
@@ -53,24 +49,21 @@ class FileExtractor:
         if not file_path:
             return
         
+        # The rebuild streams from the model file, so only its header is read here
         with open(file_path, "rb") as f:
-            self.file_data = f.read()
+            header = f.read(HEADER_SIZE)
         
-        if self.file_data[:4] != MAGIC:
+        if header[:4] != MAGIC:
             messagebox.showerror("Error", "Invalid model file format!")
             return
         
-        print (f"Rebuilder:  Model file loaded")
+        logger.info("Rebuilder: Model file loaded: %s", file_path)
             
-        self.extract_offsets()
+        self.file_path = file_path
         self.rebuild_file()
     
     def extract_offsets(self):
-        self.offsets = []
-        offset_section = self.file_data[16:16+OFFSET_SECTION_SIZE]
-        for i in range(0, OFFSET_SECTION_SIZE, 4):
-            offset, = struct.unpack_from("<I", offset_section, i)
-            self.offsets.append(offset)
+        self.offsets = extract_offsets(self.header)
     
     def show_asset_selection(self):
         self.selection_window = tk.Toplevel(self.root)
@@ -90,38 +83,52 @@ class FileExtractor:
         extract_btn.pack(pady=10)
     
     def extract_selected(self):
-        files_saved = False
-        for i, (asset_name, var) in enumerate(self.asset_vars):
+        # Ask for every output path first, then read and write the assets in the background
+        output_paths = {}
+        for asset_name, var in self.asset_vars:
             if var.get():
-                start_offset = self.offsets[i]
-                end_offset = self.find_next_offset(i)
-                asset_data = self.file_data[start_offset:end_offset]
-                
                 ext = DEFAULT_EXTENSIONS.get(asset_name, ".bin")
                 output_path = filedialog.asksaveasfilename(defaultextension=ext, initialfile=asset_name, filetypes=[("All files", "*.*")])
                 if output_path:
-                    with open(output_path, "wb") as f:
-                        f.write(asset_data)
-                    files_saved = True
-        
-        if files_saved:
-            messagebox.showinfo("Success", "Selected assets have been extracted.")
+                    output_paths[asset_name] = output_path
         self.selection_window.destroy()
+        if not output_paths:
+            return
+
+        def extract(task):
+            assets = read_assets(self.file_path, output_paths)
+            for done, (asset_name, asset_data) in enumerate(assets.items(), 1):
+                with open(output_paths[asset_name], "wb") as f:
+                    f.write(asset_data)
+                task.progress(done, len(assets))
+
+        self.worker.submit(extract, title="Extracting assets",
+                           on_done=lambda _: messagebox.showinfo("Success", "Selected assets have been extracted."))
     
-    def find_next_offset(self, index):
-        for next_offset in self.offsets[index + 1:]:
-            if next_offset != 0:
-                return next_offset
-        return len(self.file_data)
+    def extract_folder(self):
+        # Color patches of every model in a folder, stored once per unique file
+        models_folder = filedialog.askdirectory(title="Select a folder of model files")
+        if not models_folder:
+            return
+        store_folder = filedialog.askdirectory(title="Select an output folder")
+        if not store_folder:
+            return
+
+        def done(index):
+            unique = {digest for assets in index.values() for digest in assets.values()}
+            messagebox.showinfo("Success", f"Extracted {len(unique)} unique color patches from {len(index)} models.")
+
+        self.worker.submit(lambda task: bulk_extract(models_folder, store_folder, progress=task.progress),
+                           on_done=done, title="Extracting folder")
 
     def rebuild_file(self):
-        Rebuilder(self.root, self.file_data, self.offsets)
+        Rebuilder(self.root, self.file_path, self.worker)
 
 class Rebuilder:
-    def __init__(self, root, original_file_data, original_offsets):
+    def __init__(self, root, model_path, worker):
         self.root = root
-        self.original_file_data = original_file_data
-        self.original_offsets = original_offsets
+        self.model_path = model_path
+        self.worker = worker
         self.new_assets = {}
 
         self.select_input_folder()
@@ -162,58 +169,19 @@ class Rebuilder:
     def replace_selected(self):
         for asset_name, var in self.asset_vars:
             if var.get() and asset_name in self.detected_assets:
-                with open(self.detected_assets[asset_name], "rb") as f:
-                    self.new_assets[asset_name] = f.read()
+                self.new_assets[asset_name] = self.detected_assets[asset_name]
         
-        self.rebuild_model_file()
         self.selection_window.destroy()
-        messagebox.showinfo("Success", "Model file has been rebuilt with selected assets.")
+        self.rebuild_model_file()
 
     def rebuild_model_file(self):
-        new_file_data = bytearray(self.original_file_data[:16 + OFFSET_SECTION_SIZE + 8])
-        new_offsets = list(self.original_offsets)
-        current_offset = 16 + OFFSET_SECTION_SIZE + 8
-        
-        for i, asset_name in enumerate(ASSET_NAMES):
-            if asset_name in self.new_assets:
-                asset_data = self.new_assets[asset_name]
-                padded_data = self.pad_to_16_bytes(asset_data)
-                new_file_data.extend(padded_data)
-                new_offsets[i] = current_offset
-                current_offset += len(padded_data)
-            else:
-                start_offset = self.original_offsets[i]
-                if start_offset != 0:
-                    end_offset = self.find_next_offset(i)
-                    asset_data = self.original_file_data[start_offset:end_offset]
-                    padded_data = self.pad_to_16_bytes(asset_data)
-                    new_file_data.extend(padded_data)
-                    new_offsets[i] = current_offset
-                    current_offset += len(padded_data)
-                else:
-                    new_offsets[i] = 0
-        
-        # Update the total byte count
-        total_byte_count = len(new_file_data)
-        struct.pack_into("<I", new_file_data, 8, total_byte_count)
-
-        new_file_data[16:16 + OFFSET_SECTION_SIZE] = struct.pack("<" + "I" * 10, *new_offsets)
         new_file_path = filedialog.asksaveasfilename(defaultextension="", initialfile="NewModel", filetypes=[("Model files", "*.*")])
         if new_file_path:
-            with open(new_file_path, "wb") as f:
-                f.write(new_file_data)
-
-    def pad_to_16_bytes(self, data):
-        padding_needed = (16 - (len(data) % 16)) % 16
-        return data + b'\x00' * padding_needed
-
-    def find_next_offset(self, index):
-        for next_offset in self.original_offsets[index + 1:]:
-            if next_offset != 0:
-                return next_offset
-        return len(self.original_file_data)
+            self.worker.submit(lambda task: write_model(self.model_path, self.new_assets, new_file_path, task.progress), title="Rebuilding model",
+                               on_done=lambda _: messagebox.showinfo("Success", "Model file has been rebuilt with selected assets."))
 
 if __name__ == "__main__":
+    configure_from_env()
     root = tk.Tk()
     app = FileExtractor(root)
-    root.mainloop()
+    root.mainloop()
\ No newline at end of file
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import instrument
+from car4 import read_assets, write_model
+from pat_file import PatFile, add_color_entries
+
+# Job manifest keys for the color patches inside a menu model
+MODEL_PATCHES = {
+    "menu": "MainModelColorPatch",
+    "wheel": "WheelColorPatch"
+}
+
+def load_jobs(path):
+    # A manifest file with a "jobs" list, or a folder with one job.json per model code folder
+    if os.path.isdir(path):
+        jobs = []
+        for name in sorted(os.listdir(path)):
+            job_path = os.path.join(path, name, "job.json")
+            if os.path.isfile(job_path):
+                with open(job_path) as f:
+                    job = json.load(f)
+                job.setdefault("name", name)
+                jobs.append(resolve_paths(job, os.path.dirname(job_path)))
+        return jobs
+
+    with open(path) as f:
+        manifest = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return [resolve_paths(job, base_dir) for job in manifest["jobs"]]
+
+def resolve_paths(job, base_dir):
+    job = dict(job)
+    for key in ("menu_model", "lod_pat", "output"):
+        if key in job:
+            job[key] = os.path.join(base_dir, job[key])
+    for key in list(MODEL_PATCHES) + ["lod"]:
+        steps = job.get(key)
+        if steps and "png" in steps:
+            steps["png"] = {index: os.path.join(base_dir, png) for index, png in steps["png"].items()}
+        if steps and "recipes" in steps:
+            steps["recipes"] = [os.path.join(base_dir, recipe) for recipe in steps["recipes"]]
+    job.setdefault("name", os.path.basename(job.get("menu_model") or job.get("lod_pat") or "job"))
+    job.setdefault("output", os.path.join(base_dir, "output", job["name"]))
+    return job
+
+def edit_pat(data, steps):
+    # Add colors, import PNG strips into the given paints, then replay recolor recipes
+    pat = PatFile()
+    pat.load(bytearray(data))
+    data = pat.data[:pat.data_size()]
+
+    if steps.get("add_colors"):
+        data = add_color_entries(data, steps["add_colors"], steps.get("template", -1))
+
+    pat = PatFile()
+    pat.load(data)
+    if steps.get("png"):
+        from pat_png import import_paint_png
+        for paint_index, png_path in steps["png"].items():
+            paint_index = int(paint_index)
+            if paint_index < 0:
+                paint_index += pat.patch_count
+            import_paint_png(pat, paint_index, png_path)
+    if steps.get("recipes"):
+        from recolor import load_recipe, apply_recipe
+        for recipe_path in steps["recipes"]:
+            apply_recipe(pat, load_recipe(recipe_path))
+    return pat
+
+def copy_from_menu(job, menu_pats, lod_data, lod_pat, paints):
+    # Carry edited menu paints over to the lod pat through the color map built from the stock pats
+    from color_map import cached_map
+    if menu_pats is None:
+        raise ValueError(f"{job['name']}: from_menu needs a menu model with menu steps")
+    menu_data, menu_pat = menu_pats
+    stock_menu = PatFile()
+    stock_menu.load(bytearray(menu_data))
+    stock_lod = PatFile()
+    stock_lod.load(bytearray(lod_data))
+    color_map = cached_map(job["name"], stock_menu, stock_lod)
+    for paint_index in paints:
+        paint_index = int(paint_index)
+        if paint_index < 0:
+            paint_index += menu_pat.patch_count
+        color_map.transfer(menu_pat, paint_index, lod_pat, paint_index)
+
+def run_job(job, log_level="WARNING"):
+    # Runs in a worker process; timings go back to the parent with the result
+    instrument.configure_logging(log_level)
+    instrument.reset()
+    os.makedirs(job["output"], exist_ok=True)
+    results = {"name": job["name"], "outputs": []}
+    menu_pats = None
+
+    if job.get("menu_model"):
+        wanted = {key: asset_name for key, asset_name in MODEL_PATCHES.items() if key in job}
+        model_assets = read_assets(job["menu_model"], wanted.values())
+
+        new_assets = {}
+        for key, asset_name in wanted.items():
+            asset_data = model_assets.get(asset_name)
+            if asset_data is None:
+                raise ValueError(f"{job['menu_model']} has no {asset_name}")
+            pat = edit_pat(asset_data, job[key])
+            if key == "menu":
+                menu_pats = (asset_data, pat)
+            new_assets[asset_name] = pat.data
+            pat_path = os.path.join(job["output"], f"{asset_name}.pat")
+            pat.save(pat_path)
+            results["outputs"].append(pat_path)
+
+        model_path = os.path.join(job["output"], os.path.basename(job["menu_model"]))
+        write_model(job["menu_model"], new_assets, model_path)
+        results["outputs"].append(model_path)
+
+    if job.get("lod_pat"):
+        with open(job["lod_pat"], "rb") as f:
+            lod_data = f.read()
+        lod_steps = job.get("lod", {})
+        pat = edit_pat(lod_data, lod_steps)
+        if lod_steps.get("from_menu"):
+            copy_from_menu(job, menu_pats, lod_data, pat, lod_steps["from_menu"])
+        pat_path = os.path.join(job["output"], os.path.basename(job["lod_pat"]))
+        pat.save(pat_path)
+        results["outputs"].append(pat_path)
+
+    if job.get("validate", True):
+        # Fail the job rather than ship a file the game would crash on
+        from validate import validate_file
+        for output_path in results["outputs"]:
+            result = validate_file(output_path)
+            if not result["ok"]:
+                problems = "; ".join(f"[{problem['rule']}] {problem['message']}" for problem in result["problems"][:5])
+                raise ValueError(f"{output_path} failed validation: {problems}")
+
+    results["timings"] = instrument.snapshot()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run color patch jobs without the GUI.")
+    parser.add_argument("manifest", help="job manifest (.json) or a folder of model code folders containing job.json")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    jobs = load_jobs(args.manifest)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(run_job, job, args.log_level): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{job['name']}: failed: {e}", file=sys.stderr)
+                continue
+            instrument.merge(result["timings"])
+            print(f"{result['name']}: wrote {', '.join(result['outputs'])}")
+
+    instrument.finish(args)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+# Benchmarks and byte-exact round-trip checks, run with: python -m benchmarks
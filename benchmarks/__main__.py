@@ -0,0 +1,105 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from car4 import rebuild_model
+from pat_file import PatFile, add_color_entries
+from benchmarks.roundtrip import run_checks
+from benchmarks.synth import make_model, make_pat, write_file
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_mb():
+    # Peak of the whole process so far, not of a single benchmark: it only grows from row to row
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def report(name, seconds, nbytes):
+    throughput = nbytes / seconds / (1024 * 1024) if seconds else float("inf")
+    rss = peak_rss_mb()
+    rss_text = "" if rss is None else f"  process peak RSS so far {rss:8.1f} MB"
+    print(f"{name:<36} {seconds * 1000:10.3f} ms  {throughput:10.1f} MB/s{rss_text}")
+
+def run_benchmarks(args, temp_dir):
+    pat_data = make_pat(args.paints, args.patches)
+    pat_path = write_file(os.path.join(temp_dir, "synthetic.pat"), pat_data)
+    print(f"Pat0: {args.paints} paints x {args.patches} patches, {len(pat_data)} bytes")
+
+    def read(lazy):
+        pat = PatFile(pat_path)
+        pat.read(lazy=lazy)
+        pat.close()
+
+    report("PatFile.read", timed(lambda: read(False), args.repeat), len(pat_data))
+    report("PatFile.read (lazy)", timed(lambda: read(True), args.repeat), len(pat_data))
+
+    pat = PatFile(pat_path)
+    pat.read()
+    save_path = os.path.join(temp_dir, "saved.pat")
+    report("PatFile.save", timed(lambda: pat.save(save_path), args.repeat), len(pat_data))
+
+    count = 1
+    while count <= args.max_add:
+        added = add_color_entries(pat_data, count)
+        report(f"add_color_entries x{count}", timed(lambda: add_color_entries(pat_data, count), args.repeat), len(added))
+        count *= 2
+
+    try:
+        from pat_png import export_paint_png, import_paint_png, export_atlas, import_atlas
+    except ImportError:
+        print("Pillow is not installed, skipping PNG benchmarks")
+    else:
+        png_path = os.path.join(temp_dir, "paint.png")
+        paint_size = pat.colors_per_paint() * 4
+        report("create_png (one paint)", timed(lambda: export_paint_png(pat, 0, png_path), args.repeat), paint_size)
+        report("update_from_png (one paint)", timed(lambda: import_paint_png(pat, 0, png_path), args.repeat), paint_size)
+        atlas_path = os.path.join(temp_dir, "atlas.png")
+        report("export atlas", timed(lambda: export_atlas(pat, atlas_path), args.repeat), paint_size * pat.patch_count)
+        report("import atlas", timed(lambda: import_atlas(pat, atlas_path), args.repeat), paint_size * pat.patch_count)
+
+    model_data = make_model({"MainModelColorPatch": pat_data}, asset_size=args.asset_size)
+    model_path = write_file(os.path.join(temp_dir, "model"), model_data)
+    print(f"CAR4: {len(model_data)} bytes")
+    grown = add_color_entries(pat_data, 1)
+    rebuilt_path = os.path.join(temp_dir, "rebuilt")
+    report("rebuild_model", timed(lambda: rebuild_model(model_path, {"MainModelColorPatch": grown}, rebuilt_path), args.repeat), len(model_data))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Time the pat and model tools on synthetic files.")
+    parser.add_argument("--paints", type=int, default=30, help="paints in the synthetic pat")
+    parser.add_argument("--patches", type=int, default=2000, help="geometry patches per paint")
+    parser.add_argument("--max-add", type=int, default=16, help="largest number of colors to add")
+    parser.add_argument("--asset-size", type=int, default=4 * 1024 * 1024, help="size of the other synthetic model assets")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the best one is reported")
+    parser.add_argument("--skip-checks", action="store_true", help="skip the byte-exact round-trip checks")
+    args = parser.parse_args(argv)
+
+    failures = 0
+    if not args.skip_checks:
+        for name, error in run_checks():
+            print(f"check {name}: {error or 'ok'}")
+            failures += error is not None
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        run_benchmarks(args, temp_dir)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
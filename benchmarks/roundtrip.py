@@ -0,0 +1,130 @@
+import glob
+import os
+import tempfile
+
+from car4 import extract_offsets, rebuild_model, rebuild_model_data, replace_assets_in_place
+from pat_file import PatFile, add_color_entries
+from benchmarks.synth import make_model, make_pat, write_file
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Examples")
+
+def legacy_add_color_entry(data):
+    # The original color adder implementation, kept as the reference output
+    color_count = int.from_bytes(data[16:18], 'little')
+    offset_count_per_color = int.from_bytes(data[18:20], 'little')
+    offset_start = 32
+    data_start = offset_start + (color_count * offset_count_per_color * 4)
+
+    offsets = [int.from_bytes(data[i:i+4], 'little') for i in range(offset_start, data_start, 4)]
+    if color_count == 1:
+        block_size = len(data) - offsets[0]
+    else:
+        block_size = offsets[offset_count_per_color] - offsets[0]
+    offset_chunk_size = offset_count_per_color * 4
+
+    new_color_data = data[offsets[-offset_count_per_color]:offsets[-1] + block_size]
+    new_offsets = [(offset + block_size + offset_chunk_size) for offset in offsets[-offset_count_per_color:]]
+    updated_offsets = [offset + offset_chunk_size for offset in offsets]
+    new_color_count = color_count + 1
+
+    new_offset_data = b''.join(offset.to_bytes(4, 'little') for offset in new_offsets)
+    updated_offset_data = b''.join(offset.to_bytes(4, 'little') for offset in updated_offsets)
+    return (
+        data[:16] +
+        new_color_count.to_bytes(2, 'little') +
+        data[18:32] +
+        updated_offset_data +
+        new_offset_data +
+        data[data_start:] +
+        new_color_data
+    )
+
+def example_pats():
+    return sorted(glob.glob(os.path.join(EXAMPLES_DIR, "*", "*.pat")))
+
+def check_pat_roundtrip(path, temp_dir):
+    with open(path, 'rb') as f:
+        original = f.read()
+    for lazy in (False, True):
+        pat = PatFile(path)
+        pat.read(lazy=lazy)
+        output_path = os.path.join(temp_dir, "roundtrip.pat")
+        pat.save(output_path)
+        pat.close()
+        with open(output_path, 'rb') as f:
+            if f.read() != original:
+                return f"read/save (lazy={lazy}) changed the file"
+    return None
+
+def check_add_colors(path, count=3):
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    expected = data
+    for _ in range(count):
+        expected = legacy_add_color_entry(bytearray(expected))
+    if add_color_entries(data, count) != expected:
+        return f"add_color_entries({count}) differs from {count} legacy add_color_entry calls"
+    return None
+
+def check_png_roundtrip(path, temp_dir):
+    from pat_png import export_paint_png, import_paint_png
+    pat = PatFile(path)
+    pat.read()
+    original = bytes(pat.data)
+    png_path = os.path.join(temp_dir, "paint.png")
+    for paint_index in range(pat.patch_count):
+        export_paint_png(pat, paint_index, png_path)
+        import_paint_png(pat, paint_index, png_path)
+    if bytes(pat.data) != original:
+        return "PNG export/import changed the paint colors"
+
+    # Strips shipped next to the pat were exported from it
+    for png_path in glob.glob(os.path.join(os.path.dirname(path), "*_[0-9].png")):
+        from PIL import Image
+        from pat_png import paint_image
+        paint_index = int(os.path.splitext(png_path)[0].rsplit("_", 1)[1])
+        with Image.open(png_path) as png_image:
+            if png_image.width != pat.colors_per_paint() or paint_index >= pat.patch_count:
+                continue
+            if png_image.convert("RGBA").tobytes() != paint_image(pat, paint_index).tobytes():
+                return f"{os.path.basename(png_path)} does not match paint {paint_index}"
+    return None
+
+def check_model_rebuild(temp_dir):
+    pat = make_pat(9, 55)
+    model = make_model({"MainModelColorPatch": pat})
+    model_path = write_file(os.path.join(temp_dir, "model"), model)
+    offsets = extract_offsets(model)
+
+    if rebuild_model_data(model, offsets, {}) != model:
+        return "rebuild without new assets changed the model"
+
+    grown = add_color_entries(pat, 2)
+    expected = rebuild_model_data(model, offsets, {"MainModelColorPatch": grown})
+    output_path = os.path.join(temp_dir, "rebuilt")
+    rebuild_model(model_path, {"MainModelColorPatch": grown}, output_path)
+    with open(output_path, 'rb') as f:
+        if f.read() != expected:
+            return "streaming rebuild differs from the in-memory rebuild"
+
+    recolored = bytearray(pat)
+    recolored[-4:] = b'\x01\x02\x03\x04'
+    expected = rebuild_model_data(model, offsets, {"MainModelColorPatch": recolored})
+    if not replace_assets_in_place(model_path, {"MainModelColorPatch": recolored}, output_path):
+        return "same-size replacement did not take the in-place path"
+    with open(output_path, 'rb') as f:
+        if f.read() != expected:
+            return "in-place replacement differs from a full rebuild"
+    return None
+
+def run_checks():
+    # Returns a list of (name, error or None)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for path in example_pats():
+            name = os.path.relpath(path, EXAMPLES_DIR)
+            results.append((f"{name}: read/save", check_pat_roundtrip(path, temp_dir)))
+            results.append((f"{name}: add colors", check_add_colors(path)))
+            results.append((f"{name}: png", check_png_roundtrip(path, temp_dir)))
+        results.append(("synthetic CAR4: rebuild", check_model_rebuild(temp_dir)))
+    return results
@@ -0,0 +1,59 @@
+import os
+import random
+import struct
+
+from car4 import ASSET_NAMES, HEADER_SIZE as CAR4_HEADER_SIZE, MAGIC
+from pat_file import HEADER_SIZE, RECORD_HEADER_SIZE, padded_patch_size, pack_uint32_table
+
+def make_pat(patch_count, patches_per_paint, patch_sizes=None, seed=0):
+    # A well-formed Pat0 file; every paint shares the same target offsets and patch sizes
+    rng = random.Random(seed)
+    if patch_sizes is None:
+        patch_sizes = [rng.choice((2, 4, 8, 12, 28, 33, 35)) for _ in range(patches_per_paint)]
+    target_offsets = sorted(rng.sample(range(0x100, 0x100000, 2), patches_per_paint))
+
+    block_size = sum(RECORD_HEADER_SIZE + padded_patch_size(size) for size in patch_sizes)
+    data_start = HEADER_SIZE + patch_count * patches_per_paint * 4
+    data = bytearray(data_start + patch_count * block_size)
+    data[:4] = b'Pat0'
+    struct.pack_into('<HH', data, 16, patch_count, patches_per_paint)
+
+    offsets = []
+    position = data_start
+    for _ in range(patch_count):
+        for target_offset, size in zip(target_offsets, patch_sizes):
+            offsets.append(position)
+            struct.pack_into('<II', data, position, target_offset, size)
+            position += RECORD_HEADER_SIZE
+            data[position:position + padded_patch_size(size)] = rng.randbytes(padded_patch_size(size))
+            position += padded_patch_size(size)
+    data[HEADER_SIZE:data_start] = pack_uint32_table(offsets)
+    return data
+
+def make_model(assets=None, empty=("WingModelSet", "TireModel_1", "DriverModel"), asset_size=64 * 1024, seed=0):
+    # A CAR4 model with all ten asset slots; slots named in empty are left out
+    rng = random.Random(seed)
+    assets = dict(assets or {})
+    for asset_name in ASSET_NAMES:
+        if asset_name not in assets and asset_name not in empty:
+            assets[asset_name] = rng.randbytes(rng.randrange(asset_size // 2, asset_size))
+
+    data = bytearray(CAR4_HEADER_SIZE)
+    data[:4] = MAGIC
+    offsets = []
+    for asset_name in ASSET_NAMES:
+        if asset_name not in assets:
+            offsets.append(0)
+            continue
+        offsets.append(len(data))
+        data += assets[asset_name]
+        data += bytes((16 - len(data) % 16) % 16)
+    struct.pack_into('<I', data, 8, len(data))
+    struct.pack_into('<10I', data, 16, *offsets)
+    return data
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
@@ -0,0 +1,204 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from contextlib import contextmanager
+
+from instrument import logger, span, traced
+
+# Define constants
+MAGIC = b'CAR4'
+OFFSET_SECTION_SIZE = 10 * 4
+HEADER_SIZE = 16 + OFFSET_SECTION_SIZE + 8
+ASSET_NAMES = [
+    "CarInfo", "CarCollision", "MainModel", "MainModelColorPatch",
+    "WheelModel", "WheelColorPatch", "WingModelSet",
+    "TireModel_0", "TireModel_1", "DriverModel"
+]
+DEFAULT_EXTENSIONS = {
+    "MainModelColorPatch": ".pat",
+    "WheelColorPatch": ".pat"
+}
+
+def asset_filename(asset_name):
+    return asset_name + DEFAULT_EXTENSIONS.get(asset_name, ".bin")
+
+def extract_offsets(file_data):
+    if file_data[:4] != MAGIC:
+        raise ValueError("Invalid model file format!")
+    return list(struct.unpack_from("<" + "I" * 10, file_data, 16))
+
+def find_next_offset(offsets, index, file_size):
+    for next_offset in offsets[index + 1:]:
+        if next_offset != 0:
+            return next_offset
+    return file_size
+
+def asset_range(offsets, asset_name, file_size):
+    index = ASSET_NAMES.index(asset_name)
+    start_offset = offsets[index]
+    if start_offset == 0:
+        return None
+    return start_offset, find_next_offset(offsets, index, file_size)
+
+def extract_asset(file_data, offsets, asset_name):
+    region = asset_range(offsets, asset_name, len(file_data))
+    if region is None:
+        return None
+    return file_data[region[0]:region[1]]
+
+def read_model_header(f):
+    f.seek(0)
+    header = bytearray(f.read(HEADER_SIZE))
+    return header, extract_offsets(header)
+
+@traced("asset extract", nbytes=lambda assets: sum(len(data) for data in assets.values()))
+def read_assets(model_path, asset_names):
+    # Read only the header and the requested asset ranges, not the whole model
+    with open(model_path, "rb") as f:
+        header, offsets = read_model_header(f)
+        file_size = os.fstat(f.fileno()).st_size
+        assets = {}
+        for asset_name in asset_names:
+            region = asset_range(offsets, asset_name, file_size)
+            if region is not None:
+                f.seek(region[0])
+                assets[asset_name] = f.read(region[1] - region[0])
+    return assets
+
+def _asset_size(asset):
+    # New assets are given as data or as a path to a file
+    if isinstance(asset, str):
+        return os.path.getsize(asset)
+    return len(asset)
+
+def plan_rebuild(original_offsets, file_size, new_assets):
+    # Work out where every asset lands before any data is copied
+    new_offsets = []
+    layout = []
+    current_offset = HEADER_SIZE
+    for i, asset_name in enumerate(ASSET_NAMES):
+        if asset_name in new_assets:
+            size = _asset_size(new_assets[asset_name])
+            source = new_assets[asset_name]
+        elif original_offsets[i] != 0:
+            end_offset = find_next_offset(original_offsets, i, file_size)
+            size = end_offset - original_offsets[i]
+            source = (original_offsets[i], end_offset)
+        else:
+            new_offsets.append(0)
+            continue
+
+        new_offsets.append(current_offset)
+        layout.append((current_offset, size, source))
+        current_offset += size + (16 - size % 16) % 16
+    return new_offsets, layout, current_offset
+
+def _write_header(header, new_offsets, total_byte_count):
+    # Update the total byte count
+    struct.pack_into("<I", header, 8, total_byte_count)
+    header[16:16 + OFFSET_SECTION_SIZE] = struct.pack("<" + "I" * 10, *new_offsets)
+
+@traced("model rebuild", nbytes=len)
+def rebuild_model_data(original_file_data, original_offsets, new_assets):
+    new_offsets, layout, total_byte_count = plan_rebuild(original_offsets, len(original_file_data), new_assets)
+    new_file_data = bytearray(total_byte_count)
+    new_file_data[:HEADER_SIZE] = original_file_data[:HEADER_SIZE]
+    _write_header(new_file_data, new_offsets, total_byte_count)
+
+    original = memoryview(original_file_data)
+    for offset, size, source in layout:
+        if isinstance(source, tuple):
+            new_file_data[offset:offset + size] = original[source[0]:source[1]]
+        elif isinstance(source, str):
+            with open(source, "rb") as f:
+                f.readinto(memoryview(new_file_data)[offset:offset + size])
+        else:
+            new_file_data[offset:offset + size] = source
+    return new_file_data
+
+@contextmanager
+def atomic_output(output_path, mode_source=None):
+    # Write to a temp file next to the output and rename it into place only on success
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    fd, temp_path = tempfile.mkstemp(dir=output_dir)
+    os.close(fd)
+    try:
+        yield temp_path
+        if mode_source is not None:
+            shutil.copymode(mode_source, temp_path)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def rebuild_model(source_path, new_assets, output_path, progress=None):
+    # Stream the rebuilt model to disk; unchanged assets are copied straight from a map of the source.
+    # progress(done, total) is called after each asset and may raise to cancel the rebuild
+    with open(source_path, "rb") as src:
+        header, original_offsets = read_model_header(src)
+        file_size = os.fstat(src.fileno()).st_size
+    new_offsets, layout, total_byte_count = plan_rebuild(original_offsets, file_size, new_assets)
+    _write_header(header, new_offsets, total_byte_count)
+    logger.debug("Rebuild %s: offsets %s -> %s", source_path, original_offsets, new_offsets)
+
+    # The source is closed again before the output is renamed, so the output may replace it (not allowed on Windows while open)
+    with span("model rebuild", total_byte_count), atomic_output(output_path, source_path) as temp_path:
+        with open(temp_path, "wb") as out, open(source_path, "rb") as src, \
+                mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as source_map, memoryview(source_map) as original:
+            if len(source_map) != file_size:
+                raise ValueError(f"{source_path} changed during the rebuild")
+            out.write(header)
+            for offset, size, source in layout:
+                if isinstance(source, tuple):
+                    out.write(original[source[0]:source[1]])
+                elif isinstance(source, str):
+                    with open(source, "rb") as f:
+                        shutil.copyfileobj(f, out)
+                else:
+                    out.write(source)
+                out.write(b'\x00' * ((16 - size % 16) % 16))
+                if progress is not None:
+                    progress(offset + size, total_byte_count)
+    return new_offsets
+
+def replace_assets_in_place(model_path, new_assets, output_path=None, progress=None):
+    # Overwrite asset regions through a writable map when their 16-byte padded size is unchanged
+    if output_path is None:
+        output_path = model_path
+    with open(model_path, "rb") as f:
+        header, offsets = read_model_header(f)
+        file_size = os.fstat(f.fileno()).st_size
+
+    regions = []
+    for asset_name, asset in new_assets.items():
+        region = asset_range(offsets, asset_name, file_size)
+        size = _asset_size(asset)
+        if region is None or size + (16 - size % 16) % 16 != region[1] - region[0]:
+            return False
+        regions.append((region, size, asset))
+
+    logger.debug("Patching %s in place: %s", model_path, [region for region, _, _ in regions])
+    with span("model patch in place", file_size), atomic_output(output_path, model_path) as temp_path:
+        shutil.copyfile(model_path, temp_path)
+        if progress is not None:
+            progress(1, len(regions) + 1)
+        with open(temp_path, "r+b") as f, mmap.mmap(f.fileno(), 0) as model_map:
+            for step, ((start, end), size, asset) in enumerate(regions, 2):
+                if isinstance(asset, str):
+                    with open(asset, "rb") as asset_file, memoryview(model_map) as view:
+                        asset_file.readinto(view[start:start + size])
+                else:
+                    model_map[start:start + size] = asset
+                model_map[start + size:end] = bytes(end - start - size)
+                if progress is not None:
+                    progress(step, len(regions) + 1)
+            model_map.flush()
+    return True
+
+def write_model(model_path, new_assets, output_path, progress=None):
+    # Patch in place when possible, otherwise fall back to a full rebuild
+    if not replace_assets_in_place(model_path, new_assets, output_path, progress):
+        rebuild_model(model_path, new_assets, output_path, progress)
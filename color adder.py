@@ -1,47 +1,17 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox
+from history import History, added_colors_step
+from instrument import configure_from_env
+from pat_file import add_color_entries
+from worker import Worker
 
 def read_file(file_path):
     with open(file_path, 'rb') as f:
         return bytearray(f.read())
 
-def add_color_entry(data):
-    color_count = int.from_bytes(data[16:18], 'little')
-    offset_count_per_color = int.from_bytes(data[18:20], 'little')
-    offset_start = 32
-    data_start = offset_start + (color_count * offset_count_per_color * 4)
-    
-    offsets = [int.from_bytes(data[i:i+4], 'little') for i in range(offset_start, data_start, 4)]
-    if color_count == 1:
-        block_size = len(data) - offsets[0]
-    else:
-        block_size = offsets[offset_count_per_color] - offsets[0]
-    offset_chunk_size = offset_count_per_color * 4
-    
-    new_color_data = data[offsets[-offset_count_per_color]:offsets[-1] + block_size]
-    
-    new_offsets = [
-        (offset + block_size + offset_chunk_size) for offset in offsets[-offset_count_per_color:]
-    ]
-    
-    updated_offsets = [offset + offset_chunk_size for offset in offsets]
-    new_color_count = color_count + 1
-    data[16:18] = new_color_count.to_bytes(2, 'little')
-    
-    new_offset_data = b''.join(offset.to_bytes(4, 'little') for offset in new_offsets)
-    updated_offset_data = b''.join(offset.to_bytes(4, 'little') for offset in updated_offsets)
-    
-    new_data = (
-        data[:16] +
-        new_color_count.to_bytes(2, 'little') +
-        data[18:32] +
-        updated_offset_data +
-        new_offset_data +
-        data[data_start:] +
-        new_color_data
-    )
-    
-    return new_data
+def write_file(file_path, data):
+    with open(file_path, 'wb') as f:
+        f.write(data)
 
 def select_file():
     file_path = filedialog.askopenfilename(
@@ -49,18 +19,40 @@ def select_file():
         filetypes=[("PAT files", "*.pat"), ("All files", "*.*")]
     )
     if file_path:
-        data = read_file(file_path)
-        root.file_data = data
-        root.original_size = len(data)
-        update_display()
+        worker.submit(lambda task: read_file(file_path), on_done=file_loaded, title="Reading file")
+
+def file_loaded(data):
+    root.file_data = data
+    root.original_size = len(data)
+    root.history = History()
+    update_display()
 
 def add_color():
     if hasattr(root, 'file_data'):
-        root.file_data = add_color_entry(root.file_data)
+        try:
+            count = int(add_count_var.get())
+            template = int(template_var.get())
+            new_data = add_color_entries(root.file_data, count, template)
+        except (ValueError, IndexError) as e:
+            messagebox.showerror("Error", f"Failed to add colors: {e}")
+            return
+        # Only the changed header fields and the appended paints are kept for undo
+        root.history.record(added_colors_step(root.file_data, new_data))
+        root.file_data = new_data
         update_display()
     else:
         messagebox.showerror("Error", "No file loaded.")
 
+def undo(event=None):
+    if hasattr(root, 'history') and root.history.can_undo():
+        root.history.undo(root.file_data)
+        update_display()
+
+def redo(event=None):
+    if hasattr(root, 'history') and root.history.can_redo():
+        root.history.redo(root.file_data)
+        update_display()
+
 def save_file():
     if hasattr(root, 'file_data'):
         file_path = filedialog.asksaveasfilename(
@@ -69,9 +61,8 @@ def save_file():
             filetypes=[("PAT files", "*.pat"), ("All files", "*.*")]
         )
         if file_path:
-            with open(file_path, 'wb') as f:
-                f.write(root.file_data)
-            messagebox.showinfo("Success", "File saved successfully!")
+            worker.submit(lambda task: write_file(file_path, bytes(root.file_data)), title="Saving file",
+                          on_done=lambda _: messagebox.showinfo("Success", "File saved successfully!"))
     else:
         messagebox.showerror("Error", "No file loaded.")
 
@@ -86,9 +77,11 @@ def update_display():
     size_difference_label.config(text=f"Size Difference: {size_difference} bytes")
 
 # GUI setup
+configure_from_env()
 root = tk.Tk()
 root.title("Color Entry Adder")
-root.geometry("400x320")
+root.geometry("400x440")
+worker = Worker(root)
 
 select_button = tk.Button(root, text="Select File", command=select_file)
 select_button.pack(pady=10)
@@ -108,9 +101,27 @@ size_difference_label.pack(pady=5)
 size_difference_label2 = tk.Label(root, text="(Menu models) Increase the offset location values by this amount.")
 size_difference_label2.pack(pady=5)
 
+add_options_frame = tk.Frame(root)
+add_options_frame.pack(pady=5)
+
+tk.Label(add_options_frame, text="Colors to add:").pack(side=tk.LEFT)
+add_count_var = tk.StringVar(value="1")
+tk.Spinbox(add_options_frame, from_=1, to=999, width=4, textvariable=add_count_var).pack(side=tk.LEFT, padx=5)
+
+tk.Label(add_options_frame, text="Template paint (-1 = last):").pack(side=tk.LEFT)
+template_var = tk.StringVar(value="-1")
+tk.Entry(add_options_frame, width=4, textvariable=template_var).pack(side=tk.LEFT, padx=5)
+
 add_color_button = tk.Button(root, text="Add Color", command=add_color)
 add_color_button.pack(pady=10)
 
+undo_frame = tk.Frame(root)
+undo_frame.pack(pady=5)
+tk.Button(undo_frame, text="Undo", command=undo).pack(side=tk.LEFT, padx=5)
+tk.Button(undo_frame, text="Redo", command=redo).pack(side=tk.LEFT, padx=5)
+root.bind("<Control-z>", undo)
+root.bind("<Control-y>", redo)
+
 save_button = tk.Button(root, text="Save File", command=save_file)
 save_button.pack(pady=10)
 
@@ -1,313 +1,531 @@
-import struct
+import os
 import tkinter as tk
-from tkinter import filedialog, messagebox
+from tkinter import filedialog, messagebox, colorchooser
 from tkinter import ttk
 from PIL import Image, ImageTk
-
-class ScrolledCanvas(tk.Canvas):
-    def __init__(self, parent, *args, **kwargs):
-        super().__init__(parent, *args, **kwargs)
-        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.yview)
-        self.scrollable_frame = ttk.Frame(self)
-
-        self.scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.configure(
-                scrollregion=self.bbox("all")
-            )
-        )
-
-        self.create_window((0, 0), window=self.scrollable_frame, anchor="nw")
-        self.configure(yscrollcommand=self.scrollbar.set)
-
-        self.pack(side="left", fill="both", expand=True)
+from history import History
+from instrument import configure_from_env, span
+from pat_cache import PatCache
+from pat_png import paint_image, export_paint_png, export_paint_pngs, import_paint_png, export_atlas, import_atlas
+from recolor import make_recipe, save_recipe, load_recipe, apply_recipe, color_mask, paint_mask, key_color, recolor_image
+from worker import Worker
+from workspace import CarModel
+
+SWATCH_WIDTH = 30
+SWATCH_HEIGHT = 20
+ROW_HEIGHT = SWATCH_HEIGHT + 6
+LABEL_WIDTH = 300
+
+class PaintView(ttk.Frame):
+    # One paint tab; each patch row is a single swatch strip image, only rendered while visible
+    def __init__(self, parent, paint):
+        super().__init__(parent)
+        self.paint = paint
+        self.photos = {}
+
+        self.canvas = tk.Canvas(self, highlightthickness=0)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.canvas.configure(yscrollcommand=self.on_scroll)
+        self.canvas.configure(scrollregion=(0, 0, 0, len(paint['paint_data']) * ROW_HEIGHT))
+
+        self.canvas.pack(side="left", fill="both", expand=True)
         self.scrollbar.pack(side="right", fill="y")
-
-class PatFile:
-    def __init__(self, filename=None):
-        self.filename = filename
-        self.magic = b""
-        self.patch_count = 0
-        self.geometry_patches_per_color_patch = 0
-        self.patches = []
-
-    def read(self):
-        with open(self.filename, 'rb') as f:
-            # Read magic number
-            self.magic = f.read(4)
-            print(f"Magic: {self.magic}")
-            if self.magic != b'Pat0':
-                raise ValueError("Not a valid .pat file")
-
-            # Read padding
-            padding = f.read(12)
-            print(f"Padding: {padding}")
-
-            # Read patch count and geometry patches per color patch
-            patch_count_and_geometry = f.read(4)
-            self.patch_count, self.geometry_patches_per_color_patch = struct.unpack('<HH', patch_count_and_geometry)
-            print(f"Patch Count: {self.patch_count}, Geometry Patches per Color Patch: {self.geometry_patches_per_color_patch}")
-
-            # Read the offsets in the header
-            while f.tell() % 16 != 0:
-                pad_byte = f.read(1)
-                print(f"Padding Byte: {pad_byte}")
-
-            for _ in range(self.patch_count):
-                paint_patches = []
-                for _ in range(self.geometry_patches_per_color_patch):
-                    offset_bytes = f.read(4)
-                    offset = struct.unpack('<I', offset_bytes)[0]
-                    paint_patches.append(offset)
-                    print(f"Header Offset: {offset}, Bytes: {offset_bytes}")
-                self.patches.append(paint_patches)
-
-            # Read the color patches based on the offsets
-            for paint_index, paint_patches in enumerate(self.patches):
-                paint_data = []
-                for offset in paint_patches:
-                    f.seek(offset)
-                    offset_data = f.read(8)
-                    target_offset, patch_size = struct.unpack('<II', offset_data)
-                    print(f"Target Offset: {target_offset}, Patch Size: {patch_size}, Bytes: {offset_data}")
-
-                    # Read patch data
-                    actual_patch_size = patch_size
-                    remaining_bytes = (4 - patch_size % 4) % 4  # Calculate padding bytes
-                    trunc_patch_size = patch_size + remaining_bytes
-                    patch_data = f.read(trunc_patch_size)
-                    print(f"Patch Data: {actual_patch_size}")
-
-                    colors = [(patch_data[i], patch_data[i+1], patch_data[i+2], patch_data[i+3]) for i in range(0, len(patch_data), 4)]
-                    paint_data.append({
-                        'target_offset': target_offset,
-                        'patch_size': trunc_patch_size,
-                        'colors': colors,
-                        'actual_patch_size': actual_patch_size
-                    })
-                    print(f"Colors: {colors}")
-
-                self.patches[paint_index] = {
-                    'header_offsets': paint_patches,
-                    'paint_data': paint_data
-                }
-
-    def save(self, filename):
-        try:
-            with open(filename, 'wb') as f:
-                # Write magic and padding
-                f.write(b"Pat0")
-                f.write(b'\x00' * 12)
-
-                # Write patch count and geometry patches per color patch
-                patch_count = self.patch_count
-                geometry_patches_per_color_patch = self.geometry_patches_per_color_patch
-                f.write(struct.pack('<H', patch_count))
-                f.write(struct.pack('<H', geometry_patches_per_color_patch))
-
-                print(f"patch_count: {patch_count}")
-                print(f"patch_count: {geometry_patches_per_color_patch}")
-
-                # Pad to next factor of 16
-                f.write(b'\x00' * (16 - (f.tell() % 16)))
-
-                # Write header entries
-                for paint in self.patches:
-                    for header_offset in paint['header_offsets']:
-                        f.write(struct.pack('<I', header_offset))
-                
-                # Write patch data
-                for paint in self.patches:
-                    for patch_data in paint['paint_data']:
-                        f.write(struct.pack('<II', patch_data['target_offset'], patch_data['actual_patch_size']))
-                        for color in patch_data['colors']:
-                            f.write(struct.pack('<4B', *color))
-
-        except IOError as e:
-            raise IOError(f"Failed to save file: {e}")
-
-    def get_patches(self):
-        return self.patches
-        
-class CollapsibleFrame(ttk.Frame):
-    def __init__(self, parent, text="", *args, **kwargs):
-        super().__init__(parent, *args, **kwargs)
-        self.text = text
-
-        self.header_frame = ttk.Frame(self)
-        self.header_frame.pack(fill="x", pady=5)
-
-        self.toggle_button = ttk.Button(self.header_frame, text=self.text, command=self.toggle)
-        self.toggle_button.pack(side="left")
-
-        self.sub_frame = ttk.Frame(self)
-
-        self.collapsed = True
-        self.toggle()
-
-    def toggle(self):
-        if self.collapsed:
-            self.sub_frame.pack(fill="x", padx=5)
-            self.collapsed = False
-        else:
-            self.sub_frame.pack_forget()
-            self.collapsed = True
-
-class PatEditor(tk.Tk):
-    def __init__(self, pat_file):
-        super().__init__()
-        self.title("PAT File Editor")
+        self.canvas.bind("<Configure>", lambda e: self.render_visible())
+
+    def yview(self, *args):
+        self.canvas.yview(*args)
+        self.render_visible()
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.render_visible()
+
+    def visible_rows(self):
+        top = int(self.canvas.canvasy(0)) // ROW_HEIGHT
+        bottom = int(self.canvas.canvasy(self.canvas.winfo_height())) // ROW_HEIGHT + 1
+        return range(max(top, 0), min(bottom, len(self.paint['paint_data'])))
+
+    def strip_image(self, patch_data):
+        colors = patch_data['colors']
+        image = Image.frombytes("RGBA", (len(colors), 1), colors.tobytes()).convert("RGB")
+        return image.resize((len(colors) * SWATCH_WIDTH, SWATCH_HEIGHT), Image.NEAREST)
+
+    def render_visible(self):
+        for patch_index in self.visible_rows():
+            if patch_index in self.photos:
+                continue
+            patch_data = self.paint['paint_data'][patch_index]
+            y = patch_index * ROW_HEIGHT + 3
+            text = f"Patch {patch_index}    Target Offset: {patch_data['target_offset']}    Patch Size: {patch_data['actual_patch_size']}"
+            self.canvas.create_text(5, y + SWATCH_HEIGHT // 2, text=text, anchor="w")
+            photo = ImageTk.PhotoImage(self.strip_image(patch_data), master=self.canvas)
+            self.canvas.create_image(LABEL_WIDTH, y, image=photo, anchor="nw")
+            self.photos[patch_index] = photo
+
+    def refresh(self):
+        # Redraw colors in place by pasting into the existing strip images
+        for patch_index, photo in self.photos.items():
+            photo.paste(self.strip_image(self.paint['paint_data'][patch_index]))
+
+class RecolorPanel(ttk.Frame):
+    # Hue/saturation/value sliders and a target color, previewed on the current paint until applied
+    PREVIEW_WIDTH = 680
+    PREVIEW_HEIGHT = 24
+
+    def __init__(self, editor):
+        super().__init__(editor)
+        self.editor = editor
+        self.mask = None
+        self.base = None
+        self.input_rgb = None
+        self.target_rgb = None
+        self.preview = None
+        self.pending = False
+
+        self.canvas = tk.Canvas(self, width=self.PREVIEW_WIDTH, height=self.PREVIEW_HEIGHT * 2 + 2, highlightthickness=0)
+        self.canvas.pack(padx=5, pady=5)
+        self.photo = ImageTk.PhotoImage("RGB", (self.PREVIEW_WIDTH, self.PREVIEW_HEIGHT * 2 + 2), master=self.canvas)
+        self.canvas.create_image(0, 0, image=self.photo, anchor="nw")
+
+        self.hue_var = tk.IntVar(value=0)
+        self.saturation_var = tk.IntVar(value=100)
+        self.value_var = tk.IntVar(value=100)
+        for text, var, low, high in (("Hue", self.hue_var, -180, 180),
+                                     ("Saturation %", self.saturation_var, 0, 200),
+                                     ("Value %", self.value_var, 0, 200)):
+            row = ttk.Frame(self)
+            row.pack(fill='x', padx=5)
+            ttk.Label(row, text=text, width=12).pack(side='left')
+            tk.Scale(row, from_=low, to=high, orient='horizontal', variable=var, showvalue=True,
+                     command=lambda _: self.schedule_preview()).pack(side='left', fill='x', expand=True)
+
+        row = ttk.Frame(self)
+        row.pack(fill='x', padx=5, pady=5)
+        ttk.Button(row, text="Target Color...", command=self.pick_target).pack(side='left', padx=5)
+        self.target_label = ttk.Label(row, text="No target", width=14)
+        self.target_label.pack(side='left')
+        self.all_colors_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(row, text="All colors", variable=self.all_colors_var, command=self.mask_changed).pack(side='left', padx=5)
+        ttk.Button(row, text="Apply", command=self.apply).pack(side='right', padx=5)
+        ttk.Button(row, text="Reset", command=self.reset).pack(side='right', padx=5)
+
+    def hsv(self):
+        return (self.hue_var.get(), self.saturation_var.get() / 100, self.value_var.get() / 100)
+
+    def paint_changed(self):
+        # New paint or new colors: drop the cached source strip and key color
+        self.base = None
+        self.input_rgb = None
+        self.schedule_preview()
+
+    def mask_changed(self):
+        self.mask = None
+        self.paint_changed()
+
+    def schedule_preview(self):
+        # Slider events come faster than frames; only the latest state is drawn
+        if not self.pending:
+            self.pending = True
+            self.after_idle(self.update_preview)
+
+    def update_preview(self):
+        self.pending = False
+        pat_file = self.editor.pat_file
+        paint_index = self.editor.notebook.index('current')
+        with span("recolor preview", pat_file.colors_per_paint() * 4):
+            if self.mask is None:
+                if self.all_colors_var.get():
+                    self.mask = color_mask(pat_file)
+                else:
+                    self.mask = paint_mask(pat_file)
+            if self.base is None:
+                self.base = paint_image(pat_file, paint_index)
+            if self.target_rgb is not None and self.input_rgb is None:
+                self.input_rgb = key_color(self.base, self.mask)
+            self.preview, _ = recolor_image(self.base, self.mask, self.target_rgb, self.input_rgb, self.hsv())
+
+            size = (self.PREVIEW_WIDTH, self.PREVIEW_HEIGHT)
+            strips = Image.new("RGB", (self.PREVIEW_WIDTH, self.PREVIEW_HEIGHT * 2 + 2))
+            strips.paste(self.base.convert("RGB").resize(size, Image.NEAREST), (0, 0))
+            strips.paste(self.preview.convert("RGB").resize(size, Image.NEAREST), (0, self.PREVIEW_HEIGHT + 2))
+            self.photo.paste(strips)
+
+    def pick_target(self):
+        target_rgb, _ = colorchooser.askcolor(title="Target color", parent=self)
+        if target_rgb is not None:
+            self.target_rgb = tuple(int(c) for c in target_rgb)
+            self.target_label.config(text=self.editor.rgb_to_hex(self.target_rgb))
+            self.schedule_preview()
+
+    def reset(self):
+        self.hue_var.set(0)
+        self.saturation_var.set(100)
+        self.value_var.set(100)
+        self.target_rgb = None
+        self.input_rgb = None
+        self.target_label.config(text="No target")
+        self.schedule_preview()
+
+    def apply(self):
+        # Write the previewed colors into the paint and keep a recipe that replays them
+        if self.pending or self.preview is None:
+            self.update_preview()
+        paint_index = self.editor.notebook.index('current')
+        with self.editor.tracked([paint_index]):
+            self.editor.pat_file.set_paint_bytes(paint_index, self.preview.tobytes())
+        self.editor.last_recipe = make_recipe(self.target_rgb, source=paint_index, input_rgb=self.input_rgb, hsv=self.hsv(),
+                                              mask_rule="all" if self.all_colors_var.get() else "diff")
+        self.editor.paint_views[paint_index].refresh()
+        self.reset()
+        self.mask_changed()
+
+class PatEditor(tk.Toplevel):
+    def __init__(self, master, pat_file, title="PAT File Editor", save_command=None):
+        super().__init__(master)
+        self.title(title)
         self.geometry("720x600")
         self.pat_file = pat_file
+        self.save_command = save_command
+        self.paint_views = {}
+        self.last_recipe = None
+        self.history = History()
+        self.worker = Worker(self)
+        self.recolor_panel = None
         self.create_widgets()
 
     def create_widgets(self):
-        # Create a scrolled canvas for the notebook
-        self.canvas = ScrolledCanvas(self)
-        self.canvas.pack(expand=True, fill='both')
-    
-        self.notebook = ttk.Notebook(self.canvas.scrollable_frame)
+        button_frame = ttk.Frame(self)
+        button_frame.pack(side='bottom', fill='x')
+
+        self.notebook = ttk.Notebook(self)
         self.notebook.pack(expand=True, fill='both')
-    
-        for paint_index, paint in enumerate(self.pat_file.get_patches()):
-            paint_frame = ttk.Frame(self.notebook)
-            self.notebook.add(paint_frame, text=f"Paint {paint_index}")
-    
-            for patch_index, patch_data in enumerate(paint['paint_data']):
-                patch_collapse = CollapsibleFrame(paint_frame, text=f"Patch {patch_index}")
-                patch_collapse.pack(fill='x', padx=5, pady=5)
-    
-                frame = ttk.Frame(patch_collapse.sub_frame)
-                frame.pack(pady=5, fill='x')
-    
-                # Display Target Offset
-                target_offset_label = ttk.Label(frame, text=f"Target Offset: {patch_data['target_offset']}")
-                target_offset_label.pack(side='left', padx=5)
-    
-                # Display Patch Size
-                patch_size_label = ttk.Label(frame, text=f"Patch Size: {patch_data['actual_patch_size']}")
-                patch_size_label.pack(side='left', padx=5)
-    
-                # Display RGBO Colors using Canvas and rectangles
-                color_frame = ttk.Frame(frame)
-                color_frame.pack(side='left', padx=5, pady=5)
-    
-                patch_data['color_canvases'] = []
-                for color_index, color in enumerate(patch_data['colors']):
-                    color_swatch = tk.Canvas(color_frame, width=30, height=20)
-                    color_swatch.pack(side='top', pady=2)
-    
-                    rgb_color = color[:3]
-                    hex_color = self.rgb_to_hex(rgb_color)
-                    color_swatch.create_rectangle(0, 0, 30, 20, fill=hex_color)
-    
-                    patch_data['color_canvases'].append(color_swatch)
-
-        save_button = ttk.Button(self, text="Save", command=self.save_file)
+
+        # Tabs start empty and are filled in the first time they are selected
+        for paint_index in range(len(self.pat_file.get_patches())):
+            self.notebook.add(ttk.Frame(self.notebook), text=f"Paint {paint_index}")
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+        save_button = ttk.Button(button_frame, text="Save", command=self.save_file)
         save_button.pack(side='left', padx=5, pady=5)
 
-        export_button = ttk.Button(self, text="Export to PNG", command=self.export_png)
+        export_button = ttk.Button(button_frame, text="Export to PNG", command=self.export_png)
         export_button.pack(side='left', padx=5, pady=5)
 
-        load_button = ttk.Button(self, text="Import PNG", command=self.load_png)
+        load_button = ttk.Button(button_frame, text="Import PNG", command=self.load_png)
         load_button.pack(side='left', padx=5, pady=5)
 
-        self.canvas.update_idletasks()
-        self.canvas.config(scrollregion=self.canvas.bbox("all"))
-        self.canvas.bind_all("<MouseWheel>", self.on_mousewheel)
+        export_all_button = ttk.Button(button_frame, text="Export All PNGs", command=self.export_all_pngs)
+        export_all_button.pack(side='left', padx=5, pady=5)
+
+        export_atlas_button = ttk.Button(button_frame, text="Export Atlas", command=self.export_atlas_png)
+        export_atlas_button.pack(side='left', padx=5, pady=5)
+
+        load_atlas_button = ttk.Button(button_frame, text="Import Atlas", command=self.load_atlas_png)
+        load_atlas_button.pack(side='left', padx=5, pady=5)
+
+        recolor_button = ttk.Button(button_frame, text="Recolor", command=self.recolor_current)
+        recolor_button.pack(side='left', padx=5, pady=5)
+
+        save_recipe_button = ttk.Button(button_frame, text="Save Recipe", command=self.save_recipe_file)
+        save_recipe_button.pack(side='left', padx=5, pady=5)
+
+        apply_recipe_button = ttk.Button(button_frame, text="Apply Recipe", command=self.apply_recipe_file)
+        apply_recipe_button.pack(side='left', padx=5, pady=5)
+
+        self.bind("<MouseWheel>", self.on_mousewheel)
+        self.bind("<Control-z>", self.undo)
+        self.bind("<Control-y>", self.redo)
+
+    def on_tab_changed(self, event):
+        paint_index = self.notebook.index('current')
+        if self.recolor_panel is not None:
+            self.recolor_panel.paint_changed()
+        if paint_index in self.paint_views:
+            return
+        tab = self.nametowidget(self.notebook.select())
+        paint_view = PaintView(tab, self.pat_file.get_patches()[paint_index])
+        paint_view.pack(expand=True, fill='both')
+        self.paint_views[paint_index] = paint_view
 
     def rgb_to_hex(self, rgb):
         return f"#{rgb[0]:02x}{rgb[1]:02x}{rgb[2]:02x}"
 
     def save_file(self):
+        if self.save_command is not None:
+            self.save_command()
+            return
         save_path = filedialog.asksaveasfilename(defaultextension=".pat", filetypes=[("PAT files", "*.pat"), ("All files", "*.*")])
         if save_path:
-            self.pat_file.save(save_path)
-            messagebox.showinfo("Save", "File saved successfully")
+            self.worker.submit(lambda task: self.pat_file.save(save_path), title="Saving",
+                               on_done=lambda _: messagebox.showinfo("Save", "File saved successfully", parent=self))
 
     def export_png(self):
         export_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png"), ("All files", "*.*")])
         if export_path:
-            self.create_png(export_path)
-            messagebox.showinfo("Export", "PNG exported successfully")
+            # Tk is only used from the main thread, so the tab is read before the export starts
+            paint_index = self.notebook.index('current')
+            self.worker.submit(lambda task: export_paint_png(self.pat_file, paint_index, export_path), title="Exporting PNG",
+                               on_done=lambda _: messagebox.showinfo("Export", "PNG exported successfully", parent=self))
 
-    def create_png(self, path):
-        paint_index = self.notebook.index('current')
-        colors = [color for patch_data in self.pat_file.get_patches()[paint_index]['paint_data'] for color in patch_data['colors']]
-        size = len(colors)
-        image = Image.new("RGBA", (size, 1), (255, 255, 255, 0))
-        for i, color in enumerate(colors):
-            mapped_color = (color[0], color[1], color[2], color[3])
-            image.putpixel((i, 0), mapped_color)
-        image.save(path)
+    def export_all_pngs(self):
+        folder = filedialog.askdirectory(title="Select an output folder")
+        if folder:
+            self.worker.submit(lambda task: export_paint_pngs(self.pat_file, folder, progress=task.progress), title="Exporting PNGs",
+                               on_done=lambda paths: messagebox.showinfo("Export", f"{len(paths)} PNGs exported successfully", parent=self))
 
     def load_png(self):
         png_path = filedialog.askopenfilename(filetypes=[("PNG files", "*.png"), ("All files", "*.*")])
         if png_path:
-            try:
-                self.update_from_png(png_path)
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load PNG: {e}")
+            self.update_from_png(png_path)
 
     def update_from_png(self, png_path):
         paint_index = self.notebook.index('current')
-        paint = self.pat_file.get_patches()[paint_index]
-    
-        try:
-            png_image = Image.open(png_path)
-            png_pixels = png_image.load()
-    
-            # Ensure PNG width matches the number of colors in the current paint
-            if png_image.width != sum(len(patch['colors']) for patch in paint['paint_data']):
-                messagebox.showerror("Error", "PNG width does not match number of colors in the current paint")
-                return
-    
-            color_index = 0
-            for patch_data in paint['paint_data']:
-                for color_idx, color in enumerate(patch_data['colors']):
-                    new_color = png_pixels[color_index, 0]
-                    patch_data['colors'][color_idx] = new_color
-                    color_index += 1
-    
+
+        def import_png(task):
+            with self.tracked([paint_index]):
+                import_paint_png(self.pat_file, paint_index, png_path)
+
+        def done(_):
             # Update GUI with new colors
-            for patch_data in paint['paint_data']:
-                for color_index, new_color in enumerate(patch_data['colors']):
-                    rgb_hex = self.rgb_to_hex(new_color[:3])
-                    patch_data['color_canvases'][color_index].delete("all")  # Clear previous rectangle
-                    patch_data['color_canvases'][color_index].create_rectangle(0, 0, 30, 20, fill=rgb_hex)  # Update color swatch
-    
-            messagebox.showinfo("Load PNG", "PNG loaded successfully and applied to current paint")
-    
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to update from PNG: {e}")
+            self.refresh_views()
+            messagebox.showinfo("Load PNG", "PNG loaded successfully and applied to current paint", parent=self)
+
+        self.worker.submit(import_png, on_done=done, title="Loading PNG",
+                           on_error=lambda e: messagebox.showerror("Error", f"Failed to update from PNG: {e}", parent=self))
+
+    def export_atlas_png(self):
+        export_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG files", "*.png"), ("All files", "*.*")])
+        if export_path:
+            self.worker.submit(lambda task: export_atlas(self.pat_file, export_path), title="Exporting atlas",
+                               on_done=lambda _: messagebox.showinfo("Export", "Atlas exported successfully", parent=self))
+
+    def load_atlas_png(self):
+        png_path = filedialog.askopenfilename(filetypes=[("PNG files", "*.png"), ("All files", "*.*")])
+        if png_path:
+            def import_png(task):
+                with self.tracked(range(self.pat_file.patch_count)):
+                    import_atlas(self.pat_file, png_path)
+
+            def done(_):
+                self.refresh_views()
+                messagebox.showinfo("Load PNG", "Atlas loaded successfully and applied to all paints", parent=self)
+
+            self.worker.submit(import_png, on_done=done, title="Loading atlas",
+                               on_error=lambda e: messagebox.showerror("Error", f"Failed to load atlas: {e}", parent=self))
+
+    def recolor_current(self):
+        # Show or hide the recolor preview for the current paint
+        if self.recolor_panel is None:
+            self.recolor_panel = RecolorPanel(self)
+        if self.recolor_panel.winfo_ismapped():
+            self.recolor_panel.pack_forget()
+        else:
+            self.recolor_panel.pack(side='bottom', fill='x', before=self.notebook)
+            self.recolor_panel.paint_changed()
+
+    def save_recipe_file(self):
+        # The recipe replays the last recolor on other pats of the same car
+        if self.last_recipe is None:
+            messagebox.showerror("Error", "Recolor a paint first.")
+            return
+        save_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Recipe files", "*.json"), ("All files", "*.*")])
+        if save_path:
+            save_recipe(self.last_recipe, save_path)
+            messagebox.showinfo("Save", "Recipe saved successfully")
+
+    def apply_recipe_file(self):
+        recipe_path = filedialog.askopenfilename(filetypes=[("Recipe files", "*.json"), ("All files", "*.*")])
+        if recipe_path:
+            try:
+                with self.tracked(range(self.pat_file.patch_count)):
+                    apply_recipe(self.pat_file, load_recipe(recipe_path))
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to apply recipe: {e}")
+                return
+            self.refresh_views()
+
+    def tracked(self, paint_indices):
+        # Undo history records only the colors that change inside the with block
+        ranges = [color_range for paint_index in paint_indices for color_range in self.pat_file.paint_ranges(paint_index)]
+        return self.history.track(self.pat_file.data, ranges)
+
+    def refresh_views(self):
+        for paint_view in self.paint_views.values():
+            paint_view.refresh()
+        if self.recolor_panel is not None:
+            self.recolor_panel.mask_changed()
+
+    def mark_step_dirty(self, step):
+        # Undo and redo write straight into the buffer, so the next save has to know about it
+        for position, old, new in step:
+            self.pat_file.mark_dirty(position, position + len(old))
+
+    def undo(self, event=None):
+        if self.history.can_undo():
+            self.mark_step_dirty(self.history.undo(self.pat_file.data))
+            self.refresh_views()
+
+    def redo(self, event=None):
+        if self.history.can_redo():
+            self.mark_step_dirty(self.history.redo(self.pat_file.data))
+            self.refresh_views()
 
     def on_mousewheel(self, event):
-        self.canvas.yview_scroll(-1 * int(event.delta / 120), "units")
+        paint_view = self.paint_views.get(self.notebook.index('current'))
+        if paint_view is not None:
+            paint_view.canvas.yview_scroll(-1 * int(event.delta / 120), "units")
+
+class ModelWindow(tk.Toplevel):
+    # Extract, add colors, edit and rebuild a menu model without writing the pats in between
+    def __init__(self, master, model):
+        super().__init__(master)
+        self.model = model
+        self.editors = {}
+        self.info_labels = {}
+        self.worker = Worker(self)
+        self.title(f"Model - {os.path.basename(model.path)}")
+        self.geometry("520x260")
+        self.create_widgets()
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+    def create_widgets(self):
+        for asset_name in self.model.color_patches():
+            frame = ttk.LabelFrame(self, text=asset_name)
+            frame.pack(fill='x', padx=5, pady=5)
+
+            self.info_labels[asset_name] = ttk.Label(frame)
+            self.info_labels[asset_name].pack(anchor='w', padx=5)
+
+            row = ttk.Frame(frame)
+            row.pack(fill='x')
+            ttk.Button(row, text="Edit Colors", command=lambda name=asset_name: self.edit(name)).pack(side='left', padx=5, pady=5)
+
+            ttk.Label(row, text="Add:").pack(side='left')
+            count_var = tk.StringVar(value="1")
+            tk.Spinbox(row, from_=1, to=999, width=4, textvariable=count_var).pack(side='left', padx=2)
+            ttk.Label(row, text="from paint").pack(side='left')
+            template_var = tk.StringVar(value="-1")
+            ttk.Entry(row, width=4, textvariable=template_var).pack(side='left', padx=2)
+            ttk.Button(row, text="Add Colors",
+                       command=lambda name=asset_name, c=count_var, t=template_var: self.add_colors(name, c.get(), t.get())).pack(side='left', padx=5)
+
+            ttk.Button(row, text="Export .pat", command=lambda name=asset_name: self.export_pat(name)).pack(side='left', padx=5)
+            ttk.Button(row, text="Import .pat", command=lambda name=asset_name: self.import_pat(name)).pack(side='left', padx=5)
+            self.update_info(asset_name)
+
+        button_frame = ttk.Frame(self)
+        button_frame.pack(side='bottom', fill='x')
+        ttk.Button(button_frame, text="Save Model", command=self.save_model).pack(side='left', padx=5, pady=5)
+        ttk.Button(button_frame, text="Save Model As", command=self.save_model_as).pack(side='left', padx=5, pady=5)
+
+    def update_info(self, asset_name):
+        pat = self.model.pat(asset_name)
+        self.info_labels[asset_name].config(text=f"Colors: {pat.patch_count}    Size: {len(pat.data)} bytes")
+
+    def open_editor(self, asset_name):
+        editor = self.editors.get(asset_name)
+        if editor is not None and editor.winfo_exists():
+            return editor
+        return None
+
+    def edit(self, asset_name):
+        editor = self.open_editor(asset_name)
+        if editor is not None:
+            editor.lift()
+            return
+        self.editors[asset_name] = PatEditor(self, self.model.pat(asset_name), title=f"{asset_name} - {os.path.basename(self.model.path)}",
+                                             save_command=self.save_model)
+
+    def add_colors(self, asset_name, count, template):
+        try:
+            self.model.add_colors(asset_name, int(count), int(template))
+        except (ValueError, IndexError) as e:
+            messagebox.showerror("Error", f"Failed to add colors: {e}", parent=self)
+            return
+        # The editor holds the old pat, reopen it on the grown one
+        editor = self.open_editor(asset_name)
+        if editor is not None:
+            editor.destroy()
+            self.edit(asset_name)
+        self.update_info(asset_name)
+
+    def export_pat(self, asset_name):
+        save_path = filedialog.asksaveasfilename(defaultextension=".pat", initialfile=asset_name,
+                                                 filetypes=[("PAT files", "*.pat"), ("All files", "*.*")], parent=self)
+        if save_path:
+            self.worker.submit(lambda task: self.model.export_asset(asset_name, save_path), title="Exporting pat")
+
+    def import_pat(self, asset_name):
+        pat_path = filedialog.askopenfilename(filetypes=[("PAT files", "*.pat"), ("All files", "*.*")], parent=self)
+        if not pat_path:
+            return
+        with open(pat_path, "rb") as f:
+            data = f.read()
+        if data[:4] != b'Pat0':
+            messagebox.showerror("Error", "Invalid pat file format!", parent=self)
+            return
+        editor = self.open_editor(asset_name)
+        if editor is not None:
+            editor.destroy()
+        self.model.replace_asset(asset_name, data)
+        self.update_info(asset_name)
+
+    def save_model(self, output_path=None):
+        def done(_):
+            self.title(f"Model - {os.path.basename(self.model.path)}")
+            messagebox.showinfo("Save", "Model saved successfully", parent=self)
+
+        self.worker.submit(lambda task: self.model.save(output_path, progress=task.progress), on_done=done, title="Saving model",
+                           on_error=lambda e: messagebox.showerror("Error", f"Failed to save model: {e}", parent=self))
+
+    def save_model_as(self):
+        save_path = filedialog.asksaveasfilename(initialfile=os.path.basename(self.model.path), filetypes=[("Model files", "*.*")], parent=self)
+        if save_path:
+            self.save_model(save_path)
+
+    def close(self):
+        if self.model.is_modified() and not messagebox.askyesno("Close", "Discard unsaved changes to the model?", parent=self):
+            return
+        self.destroy()
 
 class MainApp(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("PAT File Selector")
         self.geometry("300x200")  # Set a reasonable default window size
+        self.worker = Worker(self)
         self.create_widgets()
 
     def create_widgets(self):
         open_button = ttk.Button(self, text="Open PAT File", command=self.open_pat_file)
         open_button.pack(expand=True)
 
+        open_model_button = ttk.Button(self, text="Open Model", command=self.open_model)
+        open_model_button.pack(expand=True)
+
     def open_pat_file(self):
         file_path = filedialog.askopenfilename(filetypes=[("PAT files", "*.pat"), ("All files", "*.*")])
         if file_path:
-            try:
-                pat = PatFile(file_path)
-                pat.read()
-                editor = PatEditor(pat)
-                self.withdraw()  # Hide the main window
-                editor.mainloop()
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to open file: {e}")
+            self.worker.submit(lambda task: PatCache().open(file_path), title="Opening pat",
+                               on_done=lambda pat: PatEditor(self, pat, title=f"PAT File Editor - {os.path.basename(file_path)}"),
+                               on_error=lambda e: messagebox.showerror("Error", f"Failed to open file: {e}", parent=self))
+
+    def open_model(self):
+        file_path = filedialog.askopenfilename(filetypes=[("All files", "*.*")])
+        if file_path:
+            self.worker.submit(lambda task: self.load_model(file_path), title="Opening model",
+                               on_done=lambda model: ModelWindow(self, model),
+                               on_error=lambda e: messagebox.showerror("Error", f"Failed to open model: {e}", parent=self))
+
+    def load_model(self, file_path):
+        # Parse the color patches up front so the model window opens without touching the disk
+        model = CarModel(file_path)
+        for asset_name in model.color_patches():
+            model.pat(asset_name)
+        return model
 
 # Run the main app
 if __name__ == "__main__":
+    configure_from_env()
     app = MainApp()
     app.mainloop()
\ No newline at end of file
@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import sys
+from array import array
+from operator import itemgetter
+
+from PIL import Image
+
+import instrument
+from color_pack import layout_fingerprint
+from instrument import logger, span
+from paint_search import KDTree
+from pat_cache import cache_dir
+from pat_file import PatFile
+from pat_png import paint_image
+
+MAP_VERSION = 1
+# RMS difference per channel, over every sample paint, above which a color has no counterpart
+MAX_DISTANCE = 16
+
+def map_dir():
+    return os.path.join(cache_dir(), "color_maps")
+
+def slot_samples(pat_file, paint_count):
+    # Each color slot as one point: its RGB in every sample paint
+    paints = [pat_file.paint_bytes(paint_index) for paint_index in range(paint_count)]
+    return [
+        [paint[position + channel] for paint in paints for channel in range(3)]
+        for position in range(0, pat_file.colors_per_paint() * 4, 4)
+    ]
+
+def match_slots(source_samples, dest_samples, max_distance=MAX_DISTANCE):
+    # For each destination slot the closest source slot, or -1 when nothing is close enough
+    dims = len(source_samples[0]) if source_samples else 0
+    tree, slots = KDTree.build(range(len(source_samples)), lambda slot: source_samples[slot], dims)
+    limit = max_distance * max_distance * dims
+    sources = []
+    exact = {tuple(sample): slot for slot, sample in enumerate(source_samples)}
+    for sample in dest_samples:
+        slot = exact.get(tuple(sample))
+        if slot is None:
+            distance, index = tree.nearest(sample, 1)[0]
+            slot = slots[index] if distance <= limit else -1
+        sources.append(slot)
+    return sources
+
+class ColorMap:
+    # Which menu color slot each lod slot copies from, and the reverse
+    def __init__(self, menu_fingerprint, lod_fingerprint, menu_to_lod, lod_to_menu):
+        self.menu_fingerprint = menu_fingerprint
+        self.lod_fingerprint = lod_fingerprint
+        self.menu_to_lod = menu_to_lod
+        self.lod_to_menu = lod_to_menu
+
+    @classmethod
+    def build(cls, menu, lod, max_distance=MAX_DISTANCE):
+        # The paints both pats share are samples of the same colors at different patch layouts
+        paint_count = min(menu.patch_count, lod.patch_count)
+        if paint_count == 0:
+            raise ValueError("Both pats need at least one paint")
+        with span("color map build", (menu.colors_per_paint() + lod.colors_per_paint()) * 4 * paint_count):
+            menu_samples = slot_samples(menu, paint_count)
+            lod_samples = slot_samples(lod, paint_count)
+            color_map = cls(layout_fingerprint(menu).hex(), layout_fingerprint(lod).hex(),
+                            match_slots(menu_samples, lod_samples, max_distance),
+                            match_slots(lod_samples, menu_samples, max_distance))
+        logger.info("Color map: %d of %d lod colors follow the menu pat, %d of %d menu colors follow the lod pat",
+                    sum(slot >= 0 for slot in color_map.menu_to_lod), len(color_map.menu_to_lod),
+                    sum(slot >= 0 for slot in color_map.lod_to_menu), len(color_map.lod_to_menu))
+        return color_map
+
+    def fits(self, menu, lod):
+        return (self.menu_fingerprint == layout_fingerprint(menu).hex() and
+                self.lod_fingerprint == layout_fingerprint(lod).hex())
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({
+                "version": MAP_VERSION,
+                "menu_fingerprint": self.menu_fingerprint,
+                "lod_fingerprint": self.lod_fingerprint,
+                "menu_to_lod": self.menu_to_lod,
+                "lod_to_menu": self.lod_to_menu
+            }, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != MAP_VERSION:
+            raise ValueError(f"Unsupported color map version: {data.get('version')}")
+        return cls(data["menu_fingerprint"], data["lod_fingerprint"], data["menu_to_lod"], data["lod_to_menu"])
+
+    def transfer(self, source, source_paint, dest, dest_paint, to_lod=True):
+        # One gather of the source paint's colors into the destination layout; unmatched colors and opacity stay
+        sources = self.menu_to_lod if to_lod else self.lod_to_menu
+        if len(sources) != dest.colors_per_paint():
+            raise ValueError("The color map does not fit the destination pat")
+        with span("color map transfer", dest.colors_per_paint() * 4):
+            colors = array('I')
+            colors.frombytes(source.paint_bytes(source_paint))
+            # Unmatched slots gather a dummy color that the mask leaves out
+            colors.append(0)
+            gathered = array('I', itemgetter(*sources)(colors)) if len(sources) > 1 else array('I', [colors[sources[0]]])
+            size = (len(sources), 1)
+            original = paint_image(dest, dest_paint)
+            image = Image.frombytes("RGBA", size, gathered.tobytes())
+            image.putalpha(original.getchannel("A"))
+            mask = Image.frombytes("L", size, bytes(0 if slot < 0 else 255 for slot in sources))
+            dest.set_paint_bytes(dest_paint, Image.composite(image, original, mask).tobytes())
+
+def cached_map(model_code, menu, lod, rebuild=False):
+    # Maps are kept per model code and rebuilt when either pat's layout no longer matches
+    path = os.path.join(map_dir(), f"{model_code}.json")
+    if not rebuild and os.path.isfile(path):
+        try:
+            color_map = ColorMap.load(path)
+            if color_map.fits(menu, lod):
+                return color_map
+        except (ValueError, KeyError, OSError):
+            pass
+    color_map = ColorMap.build(menu, lod)
+    color_map.save(path)
+    return color_map
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Copy an edited paint between the menu and lod/open pats of a car.")
+    parser.add_argument("model_code", help="model code the map is cached under, e.g. hond0008")
+    parser.add_argument("menu", help="menu .pat file (MainModelColorPatch)")
+    parser.add_argument("lod", help="lod/open .pat file")
+    parser.add_argument("--paint", type=int, action="append", dest="paints", required=True,
+                        help="paint to copy (repeatable, negative counts from the last paint)")
+    parser.add_argument("--to", choices=("lod", "menu"), default="lod", help="which pat receives the paint")
+    parser.add_argument("-o", "--output", required=True, help="output .pat file")
+    parser.add_argument("--stock-menu", help="unedited menu pat to build the map from (default: menu)")
+    parser.add_argument("--stock-lod", help="unedited lod pat to build the map from (default: lod)")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild the cached map")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    pats = {}
+    for name, path in (("menu", args.menu), ("lod", args.lod), ("stock_menu", args.stock_menu or args.menu),
+                       ("stock_lod", args.stock_lod or args.lod)):
+        pats[name] = PatFile(path)
+        pats[name].read()
+    color_map = cached_map(args.model_code, pats["stock_menu"], pats["stock_lod"], args.rebuild)
+
+    source, dest = (pats["menu"], pats["lod"]) if args.to == "lod" else (pats["lod"], pats["menu"])
+    for paint_index in args.paints:
+        if paint_index < 0:
+            paint_index += source.patch_count
+        if not 0 <= paint_index < dest.patch_count:
+            raise IndexError(f"The {args.to} pat has no paint {paint_index}, add colors to it first")
+        color_map.transfer(source, paint_index, dest, paint_index, to_lod=args.to == "lod")
+    dest.save(args.output)
+    print(f"Copied {len(args.paints)} paints into {args.output}")
+
+    instrument.finish(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import argparse
+import hashlib
+import os
+import struct
+import sys
+import zlib
+
+import instrument
+from car4 import MAGIC
+from instrument import logger, span
+from pat_file import PatFile, add_color_entries, pack_uint32_table
+from workspace import CarModel
+
+PACK_MAGIC = b'PatK'
+PACK_VERSION = 1
+# magic, version, paint index (-1 = added paint), colors per paint, name size, layout fingerprint, compressed size
+PACK_HEADER = struct.Struct('<4sHhIH32sI')
+ADDED = -1
+
+def layout_fingerprint(pat_file):
+    # Paints only fit pats with the same target offsets and patch sizes; added paints don't change these
+    return hashlib.sha256(
+        struct.pack('<H', pat_file.geometry_patches_per_color_patch) +
+        pack_uint32_table(pat_file.target_offsets) +
+        pack_uint32_table(pat_file.patch_sizes)
+    ).digest()
+
+class ColorPack:
+    def __init__(self, fingerprint, colors, paint_index=ADDED, name=""):
+        self.fingerprint = fingerprint
+        self.colors = colors
+        self.paint_index = paint_index
+        self.name = name
+
+    def tobytes(self):
+        name = self.name.encode("utf-8")
+        compressed = zlib.compress(self.colors, 9)
+        return PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, self.paint_index, len(self.colors) // 4,
+                                len(name), self.fingerprint, len(compressed)) + name + compressed
+
+def make_pack(pat_file, paint_index, added=True, name=""):
+    # added packs are appended as new paints, the others overwrite the same paint of the stock pat
+    return ColorPack(layout_fingerprint(pat_file), pat_file.paint_bytes(paint_index), ADDED if added else paint_index, name)
+
+def diff_packs(stock, pat_file, paints=None):
+    # One pack per paint that was edited or added compared to the stock pat
+    if layout_fingerprint(stock) != layout_fingerprint(pat_file):
+        raise ValueError("The pats have different patch layouts")
+    if paints is None:
+        paints = range(pat_file.patch_count)
+    packs = []
+    for paint_index in paints:
+        if paint_index >= stock.patch_count:
+            packs.append(make_pack(pat_file, paint_index, name=f"Paint {paint_index}"))
+        elif pat_file.paint_bytes(paint_index) != stock.paint_bytes(paint_index):
+            packs.append(make_pack(pat_file, paint_index, added=False, name=f"Paint {paint_index}"))
+    return packs
+
+def parse_packs(data):
+    # Pack files may hold any number of packs back to back
+    packs = []
+    position = 0
+    while position < len(data):
+        magic, version, paint_index, color_count, name_size, fingerprint, compressed_size = PACK_HEADER.unpack_from(data, position)
+        if magic != PACK_MAGIC:
+            raise ValueError("Not a color pack")
+        if version != PACK_VERSION:
+            raise ValueError(f"Unsupported color pack version: {version}")
+        position += PACK_HEADER.size
+        name = bytes(data[position:position + name_size]).decode("utf-8")
+        position += name_size
+        colors = zlib.decompress(data[position:position + compressed_size])
+        position += compressed_size
+        if len(colors) != color_count * 4:
+            raise ValueError(f"Color pack {name!r} is damaged")
+        packs.append(ColorPack(fingerprint, colors, paint_index, name))
+    return packs
+
+def read_packs(path):
+    with open(path, "rb") as f:
+        return parse_packs(f.read())
+
+def write_packs(packs, path):
+    with open(path, "wb") as f:
+        for pack in packs:
+            f.write(pack.tobytes())
+
+def apply_packs(pat_file, packs):
+    # Edited paints are written in place; all added paints are appended in one re-layout of the file
+    fingerprint = layout_fingerprint(pat_file)
+    color_bytes = pat_file.colors_per_paint() * 4
+    for pack in packs:
+        if pack.fingerprint != fingerprint or len(pack.colors) != color_bytes:
+            raise ValueError(f"Color pack {pack.name!r} was made for a different pat")
+        if pack.paint_index >= pat_file.patch_count:
+            raise IndexError(f"Color pack {pack.name!r} edits paint {pack.paint_index}, the pat has {pat_file.patch_count}")
+
+    added = [pack for pack in packs if pack.paint_index == ADDED]
+    with span("color pack apply", color_bytes * len(packs)):
+        if added:
+            first_added = pat_file.patch_count
+            data = add_color_entries(pat_file.data[:pat_file.data_size()], len(added))
+            pat_file.close()
+            pat_file.load(data)
+            for paint_index, pack in enumerate(added, first_added):
+                pat_file.set_paint_bytes(paint_index, pack.colors)
+        for pack in packs:
+            if pack.paint_index != ADDED:
+                pat_file.set_paint_bytes(pack.paint_index, pack.colors)
+    logger.info("Applied %d color packs, %d added paints", len(packs), len(added))
+    return pat_file
+
+def apply_packs_to_file(path, packs, output_path, asset_name="MainModelColorPatch"):
+    # Works on plain .pat files and on the color patch inside a CAR4 model
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == MAGIC:
+        model = CarModel(path)
+        apply_packs(model.pat(asset_name), packs)
+        model.save(output_path)
+    else:
+        pat = PatFile(path)
+        pat.read()
+        apply_packs(pat, packs)
+        pat.save(output_path)
+    return output_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share custom paints as small color packs.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write the paints that differ from the stock pat as color packs")
+    export_parser.add_argument("stock", help="stock .pat file")
+    export_parser.add_argument("pat", help="edited .pat file")
+    export_parser.add_argument("-o", "--output", required=True, help="output pack file")
+    export_parser.add_argument("--paint", type=int, action="append", dest="paints", help="only export this paint (repeatable)")
+
+    apply_parser = commands.add_parser("apply", help="apply color packs to a pat file or menu model")
+    apply_parser.add_argument("target", help=".pat file or CAR4 model")
+    apply_parser.add_argument("packs", nargs="+", help="color pack files, applied in order")
+    apply_parser.add_argument("-o", "--output", required=True, help="output file")
+    apply_parser.add_argument("--asset", default="MainModelColorPatch", help="color patch to edit inside CAR4 models")
+
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    if args.command == "export":
+        stock = PatFile(args.stock)
+        stock.read()
+        pat = PatFile(args.pat)
+        pat.read()
+        packs = diff_packs(stock, pat, args.paints)
+        write_packs(packs, args.output)
+        print(f"{args.output}: {len(packs)} packs, {os.path.getsize(args.output)} bytes")
+    else:
+        packs = [pack for path in args.packs for pack in read_packs(path)]
+        apply_packs_to_file(args.target, packs, args.output, args.asset)
+        print(f"{args.target}: applied {len(packs)} packs, wrote {args.output}")
+
+    instrument.finish(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
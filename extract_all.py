@@ -0,0 +1,80 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import instrument
+from car4 import MAGIC, asset_filename, read_assets
+
+COLOR_PATCH_ASSETS = ("MainModelColorPatch", "WheelColorPatch")
+
+def find_models(root_dir):
+    for folder, _, filenames in os.walk(root_dir):
+        for filename in sorted(filenames):
+            path = os.path.join(folder, filename)
+            with open(path, "rb") as f:
+                if f.read(4) == MAGIC:
+                    yield path
+
+def store_path(store_dir, digest, asset_name):
+    _, ext = os.path.splitext(asset_filename(asset_name))
+    return os.path.join(store_dir, digest[:2], digest + ext)
+
+def store_asset(store_dir, asset_name, data):
+    # Assets are stored under their hash, so pats shared between models are written once
+    digest = hashlib.sha256(data).hexdigest()
+    path = store_path(store_dir, digest, asset_name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    return digest
+
+def extract_model(model_path, store_dir, asset_names):
+    assets = read_assets(model_path, asset_names)
+    return {asset_name: store_asset(store_dir, asset_name, data) for asset_name, data in assets.items()}
+
+def bulk_extract(root_dir, store_dir, asset_names=COLOR_PATCH_ASSETS, workers=None, progress=None):
+    # Returns {model path relative to root_dir: {asset name: hash}} and writes it as index.json.
+    # progress(done, total) is called as models finish and may raise to stop early
+    os.makedirs(store_dir, exist_ok=True)
+    models = list(find_models(root_dir))
+    index = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda path: extract_model(path, store_dir, asset_names), models)
+        try:
+            for done, (path, assets) in enumerate(zip(models, results), 1):
+                index[os.path.relpath(path, root_dir)] = assets
+                if progress is not None:
+                    progress(done, len(models))
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    with open(os.path.join(store_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract color patches from every CAR4 model in a folder.")
+    parser.add_argument("folder", help="folder to search for CAR4 models, e.g. the game's menu folder")
+    parser.add_argument("store", help="output folder; assets are stored once per unique content")
+    parser.add_argument("--asset", action="append", dest="assets", help="asset to extract (default: both color patches)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker threads")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    index = bulk_extract(args.folder, args.store, args.assets or COLOR_PATCH_ASSETS, args.jobs)
+    unique = {digest for assets in index.values() for digest in assets.values()}
+    total = sum(len(assets) for assets in index.values())
+    print(f"{len(index)} models, {total} assets, {len(unique)} unique")
+    instrument.finish(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+from contextlib import contextmanager
+
+from pat_file import HEADER_SIZE
+
+class History:
+    # Undo/redo for byte buffers; a step is a list of (position, old bytes, new bytes) splices
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.undo_steps = []
+        self.redo_steps = []
+        self.size = 0
+
+    def _step_size(self, step):
+        return sum(len(old) + len(new) for _, old, new in step)
+
+    def record(self, step):
+        if not step:
+            return
+        self.undo_steps.append(step)
+        self.size += self._step_size(step)
+        for redo_step in self.redo_steps:
+            self.size -= self._step_size(redo_step)
+        self.redo_steps = []
+        # Forget the oldest steps once the history gets too big
+        while self.size > self.max_bytes and len(self.undo_steps) > 1:
+            self.size -= self._step_size(self.undo_steps.pop(0))
+
+    @contextmanager
+    def track(self, data, ranges):
+        # Record the edits made to the given (start, end) ranges of data inside the with block
+        before = [bytes(data[start:end]) for start, end in ranges]
+        try:
+            yield
+        finally:
+            self.record(self._changes(data, ranges, before))
+
+    def _changes(self, data, ranges, before):
+        step = []
+        for (start, end), old in zip(ranges, before):
+            new = bytes(data[start:end])
+            if new == old:
+                continue
+            # Keep only the part of the range that changed
+            first = 0
+            while old[first] == new[first]:
+                first += 1
+            last = len(old)
+            while old[last - 1] == new[last - 1]:
+                last -= 1
+            step.append((start + first, old[first:last], new[first:last]))
+        return step
+
+    def can_undo(self):
+        return bool(self.undo_steps)
+
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    def undo(self, data):
+        step = self.undo_steps.pop()
+        for position, old, new in reversed(step):
+            data[position:position + len(new)] = old
+        self.redo_steps.append(step)
+        return step
+
+    def redo(self, data):
+        step = self.redo_steps.pop()
+        for position, old, new in step:
+            data[position:position + len(old)] = new
+        self.undo_steps.append(step)
+        return step
+
+def added_colors_step(old_data, new_data):
+    # Splices that turn a pat into the result of add_color_entries: color count, offset table, appended paints
+    old_table_end = HEADER_SIZE + int.from_bytes(old_data[16:18], 'little') * int.from_bytes(old_data[18:20], 'little') * 4
+    new_table_end = HEADER_SIZE + int.from_bytes(new_data[16:18], 'little') * int.from_bytes(new_data[18:20], 'little') * 4
+    appended_start = len(old_data) + new_table_end - old_table_end
+    return [
+        (16, bytes(old_data[16:18]), bytes(new_data[16:18])),
+        (HEADER_SIZE, bytes(old_data[HEADER_SIZE:old_table_end]), bytes(new_data[HEADER_SIZE:new_table_end])),
+        (appended_start, b'', bytes(new_data[appended_start:]))
+    ]
@@ -0,0 +1,103 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("gt4pat")
+
+_lock = threading.Lock()
+# name -> [count, total seconds, max seconds, total bytes]
+_spans = {}
+
+def record(name, seconds, nbytes=0):
+    with _lock:
+        stats = _spans.setdefault(name, [0, 0.0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        stats[3] += nbytes
+
+@contextmanager
+def span(name, nbytes=0):
+    # Time a named phase; nbytes is the amount of data it handled
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, nbytes)
+
+def traced(name, nbytes=None):
+    # Decorator form of span; nbytes, if given, measures the result
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            record(name, time.perf_counter() - start, nbytes(result) if nbytes else 0)
+            return result
+        return wrapper
+    return decorator
+
+def snapshot():
+    with _lock:
+        return {name: list(stats) for name, stats in _spans.items()}
+
+def merge(other):
+    # Fold in a snapshot taken in another process
+    with _lock:
+        for name, (count, seconds, max_seconds, nbytes) in other.items():
+            stats = _spans.setdefault(name, [0, 0.0, 0.0, 0])
+            stats[0] += count
+            stats[1] += seconds
+            stats[2] = max(stats[2], max_seconds)
+            stats[3] += nbytes
+
+def reset():
+    with _lock:
+        _spans.clear()
+
+def summary():
+    result = {}
+    for name, (count, seconds, max_seconds, nbytes) in sorted(snapshot().items()):
+        result[name] = {
+            "count": count,
+            "total_ms": seconds * 1000,
+            "max_ms": max_seconds * 1000,
+            "bytes": nbytes,
+            "mb_per_s": nbytes / seconds / (1024 * 1024) if seconds and nbytes else None
+        }
+    return result
+
+def format_summary():
+    lines = [f"{'span':<24} {'count':>7} {'total ms':>11} {'max ms':>10} {'bytes':>12}"]
+    for name, stats in summary().items():
+        lines.append(f"{name:<24} {stats['count']:>7} {stats['total_ms']:>11.3f} {stats['max_ms']:>10.3f} {stats['bytes']:>12}")
+    return "\n".join(lines)
+
+def export_summary(path):
+    with open(path, "w") as f:
+        json.dump(summary(), f, indent=2)
+
+def configure_logging(level="WARNING"):
+    logging.basicConfig(level=getattr(logging, str(level).upper()), format="%(name)s: %(message)s")
+
+def add_arguments(parser):
+    parser.add_argument("--log-level", default="WARNING", help="DEBUG dumps every header offset and color")
+    parser.add_argument("--timings", metavar="PATH", help="write per-phase timings as JSON")
+
+def finish(args):
+    if args.timings:
+        export_summary(args.timings)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Timings:\n%s", format_summary())
+
+def configure_from_env():
+    # For the GUIs: GT4PAT_LOG_LEVEL sets the log level, GT4PAT_TIMINGS names a JSON file written on exit
+    configure_logging(os.environ.get("GT4PAT_LOG_LEVEL", "WARNING"))
+    timings_path = os.environ.get("GT4PAT_TIMINGS")
+    if timings_path:
+        atexit.register(export_summary, timings_path)
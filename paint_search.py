@@ -0,0 +1,234 @@
+import argparse
+import heapq
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops, ImageCms
+
+import instrument
+from instrument import logger, span
+from pat_cache import cache_dir
+from pat_file import PatFile
+from pat_png import paint_image
+from recolor import paint_mask, key_color
+
+INDEX_VERSION = 3
+# Histogram bins along L, a and b
+HISTOGRAM_BINS = (4, 3, 3)
+HISTOGRAM_WEIGHT = 50.0
+
+_lab_transform = None
+
+def default_index_path():
+    return os.path.join(cache_dir(), "paint_index.json")
+
+def to_lab(image):
+    # Pillow's LAB mode stores L as 0-255 and a/b offset by 128
+    global _lab_transform
+    if _lab_transform is None:
+        _lab_transform = ImageCms.buildTransformFromOpenProfiles(
+            ImageCms.createProfile("sRGB"), ImageCms.createProfile("LAB"), "RGB", "LAB")
+    return ImageCms.applyTransform(image.convert("RGB"), _lab_transform)
+
+def rgb_to_lab(rgb):
+    l, a, b = to_lab(Image.new("RGB", (1, 1), tuple(rgb))).getpixel((0, 0))
+    return [round(l * 100 / 255, 2), a - 128, b - 128]
+
+def _bin_lut(bins, scale):
+    return [min(value * bins // 256, bins - 1) * scale for value in range(256)]
+
+def lab_histogram(image, mask):
+    # Normalized joint L/a/b histogram of the masked pixels, built with lookup tables and one histogram() call
+    l_bins, a_bins, b_bins = HISTOGRAM_BINS
+    l, a, b = to_lab(image).split()
+    bins = ImageChops.add(ImageChops.add(
+        l.point(_bin_lut(l_bins, a_bins * b_bins)),
+        a.point(_bin_lut(a_bins, b_bins))),
+        b.point(_bin_lut(b_bins, 1)))
+    counts = bins.histogram(mask)[:l_bins * a_bins * b_bins]
+    total = sum(counts) or 1
+    return [round(count / total, 4) for count in counts]
+
+def paint_signature(pat_file, paint_index, mask):
+    image = paint_image(pat_file, paint_index)
+    rgb = key_color(image, mask)
+    return {"rgb": list(rgb), "lab": rgb_to_lab(rgb), "histogram": lab_histogram(image, mask)}
+
+def pat_signatures(path):
+    # Runs in a worker process
+    pat = PatFile(path)
+    pat.read()
+    with span("paint signatures", pat.colors_per_paint() * 4 * pat.patch_count):
+        mask = paint_mask(pat)
+        return [paint_signature(pat, paint_index, mask) for paint_index in range(pat.patch_count)]
+
+def find_pats(folder):
+    # A store written by extract_all names each pat by hash; its index.json says which models use it
+    models = {}
+    store_index = os.path.join(folder, "index.json")
+    if os.path.isfile(store_index):
+        with open(store_index) as f:
+            for model, assets in json.load(f).items():
+                for digest in assets.values():
+                    models.setdefault(digest, []).append(model)
+
+    for root, _, filenames in os.walk(folder):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(".pat"):
+                path = os.path.join(root, filename)
+                name = os.path.splitext(filename)[0]
+                yield path, models.get(name) or [os.path.basename(root)]
+
+class KDTree:
+    # Implicit balanced k-d tree: points are kept in tree order, the middle of each range is its node
+    def __init__(self, points, dims=3):
+        self.points = points
+        self.dims = dims
+
+    @classmethod
+    def build(cls, items, key, dims=3):
+        # Returns the tree and the items rearranged into tree order
+        items = list(items)
+
+        def arrange(lo, hi, depth):
+            if hi - lo <= 1:
+                return
+            axis = depth % dims
+            items[lo:hi] = sorted(items[lo:hi], key=lambda item: key(item)[axis])
+            mid = (lo + hi) // 2
+            arrange(lo, mid, depth + 1)
+            arrange(mid + 1, hi, depth + 1)
+
+        arrange(0, len(items), 0)
+        return cls([list(key(item)) for item in items], dims), items
+
+    def nearest(self, point, k=1):
+        # [(squared distance, index)] of the k closest points, closest first
+        best = []
+
+        def search(lo, hi, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            node = self.points[mid]
+            distance = sum((a - b) ** 2 for a, b in zip(point, node))
+            if len(best) < k:
+                heapq.heappush(best, (-distance, mid))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, mid))
+
+            axis = depth % self.dims
+            difference = point[axis] - node[axis]
+            near, far = ((lo, mid), (mid + 1, hi)) if difference < 0 else ((mid + 1, hi), (lo, mid))
+            search(*near, depth + 1)
+            # The other side can only hold closer points if the splitting plane is closer than the worst match
+            if len(best) < k or difference * difference < -best[0][0]:
+                search(*far, depth + 1)
+
+        search(0, len(self.points), 0)
+        return sorted((-distance, index) for distance, index in best)
+
+class PaintIndex:
+    def __init__(self, entries):
+        # Entries are stored in tree order, so loading needs no rebuild
+        self.entries = entries
+        self.tree = KDTree([entry["lab"] for entry in entries])
+
+    @classmethod
+    def build(cls, folder, workers=None):
+        pats = list(find_pats(folder))
+        entries = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for (path, models), signatures in zip(pats, executor.map(pat_signatures, [path for path, _ in pats])):
+                relative_path = os.path.relpath(path, folder)
+                for paint_index, signature in enumerate(signatures):
+                    entries.append(dict(signature, models=models, pat=relative_path, paint=paint_index))
+        logger.info("Indexed %d paints from %d pats", len(entries), len(pats))
+        _, entries = KDTree.build(entries, lambda entry: entry["lab"])
+        return cls(entries)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "entries": self.entries}, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported paint index version: {index.get('version')}")
+        return cls(index["entries"])
+
+    def nearest_rgb(self, rgb, k=10):
+        # [(delta E, entry)], delta E being the Lab distance of the key colors
+        lab = rgb_to_lab(rgb)
+        with span("paint search"):
+            return [(distance ** 0.5, self.entries[index]) for distance, index in self.tree.nearest(lab, k)]
+
+    def similar(self, pat_file, paint_index, k=10):
+        # Key color candidates re-ranked with the histogram, so paints with the same overall mix come first
+        signature = paint_signature(pat_file, paint_index, paint_mask(pat_file))
+        with span("paint search"):
+            candidates = self.tree.nearest(signature["lab"], k * 4)
+            ranked = []
+            for distance, index in candidates:
+                entry = self.entries[index]
+                histogram_distance = sum(abs(a - b) for a, b in zip(signature["histogram"], entry["histogram"]))
+                ranked.append((distance ** 0.5 + HISTOGRAM_WEIGHT * histogram_distance, entry))
+            ranked.sort(key=lambda result: result[0])
+            return ranked[:k]
+
+def parse_rgb(values):
+    if len(values) == 1:
+        value = values[0].lstrip("#")
+        return tuple(int(value[i:i + 2], 16) for i in (0, 2, 4))
+    return tuple(int(value) for value in values)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find factory paints close to a color across many pats.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="index every paint of the pats in a folder")
+    build_parser.add_argument("folder", help="folder of .pat files, e.g. one folder per model code or an extract_all store")
+    build_parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+
+    query_parser = commands.add_parser("query", help="closest paints to a color")
+    query_parser.add_argument("rgb", nargs="+", help="R G B, or a hex color like f8b915")
+    query_parser.add_argument("-k", type=int, default=10, help="number of results")
+
+    similar_parser = commands.add_parser("similar", help="paints closest to a paint of a pat")
+    similar_parser.add_argument("pat", help=".pat file")
+    similar_parser.add_argument("paint", type=int, help="paint index")
+    similar_parser.add_argument("-k", type=int, default=10, help="number of results")
+
+    parser.add_argument("--index", default=default_index_path(), help="index file (default: in the cache folder)")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    if args.command == "build":
+        index = PaintIndex.build(args.folder, args.jobs)
+        index.save(args.index)
+        print(f"{len(index.entries)} paints indexed into {args.index}")
+    else:
+        index = PaintIndex.load(args.index)
+        if args.command == "query":
+            results = index.nearest_rgb(parse_rgb(args.rgb), args.k)
+        else:
+            pat = PatFile(args.pat)
+            pat.read()
+            results = index.similar(pat, args.paint, args.k)
+        for distance, entry in results:
+            rgb = "#{:02x}{:02x}{:02x}".format(*entry["rgb"])
+            print(f"{distance:7.2f}  {rgb}  {', '.join(entry['models'])}  {entry['pat']}  paint {entry['paint']}")
+
+    instrument.finish(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import hashlib
+import mmap
+import os
+import struct
+
+from instrument import logger, span
+from pat_file import PatFile, read_uint32_table, pack_uint32_table
+
+CACHE_MAGIC = b'PatC'
+CACHE_VERSION = 1
+# magic, version, source size, source mtime (ns), source sha256, patch count, patches per paint, data offset
+ENTRY_HEADER = struct.Struct('<4sIQQ32sHHI')
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+def cache_dir():
+    return os.environ.get("GT4PAT_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "gt4-pat-editor")
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+class PatCache:
+    # Parsed pats on disk: the offset and layout tables followed by the raw file, ready to map
+    def __init__(self, directory=None, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory or os.path.join(cache_dir(), "pats")
+        self.max_size = max_size
+
+    def entry_path(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + ".patc")
+
+    def open(self, path, cache_size=8):
+        stat = os.stat(path)
+        entry_path = self.entry_path(path)
+        pat = None
+        if os.path.exists(entry_path):
+            try:
+                with span("cache load", stat.st_size):
+                    pat = self._load(entry_path, path, stat, cache_size)
+            except (ValueError, OSError, struct.error):
+                pat = None
+        if pat is None:
+            pat = PatFile(path)
+            pat.read(lazy=True, cache_size=cache_size)
+            # The cache only saves time, a cache folder that can't be written must not stop the pat from opening
+            try:
+                with span("cache store", stat.st_size):
+                    self._store(entry_path, pat, stat)
+            except OSError as e:
+                logger.warning("Could not write the pat cache entry for %s: %s", path, e)
+        return pat
+
+    def _load(self, entry_path, path, stat, cache_size):
+        with open(entry_path, "r+b") as f:
+            header = f.read(ENTRY_HEADER.size)
+            magic, version, size, mtime_ns, digest, patch_count, patches_per_paint, data_offset = ENTRY_HEADER.unpack(header)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION or size != stat.st_size:
+                return None
+            if mtime_ns != stat.st_mtime_ns:
+                # Touched but maybe not changed; the content hash decides
+                if file_digest(path) != digest:
+                    return None
+                f.seek(0)
+                f.write(ENTRY_HEADER.pack(magic, version, size, stat.st_mtime_ns, digest, patch_count, patches_per_paint, data_offset))
+        os.utime(entry_path)
+
+        entry_file = open(entry_path, "rb")
+        entry_map = None
+        try:
+            entry_map = mmap.mmap(entry_file.fileno(), 0, access=mmap.ACCESS_COPY)
+            if len(entry_map) < data_offset + size:
+                raise ValueError("Truncated pat cache entry")
+            table_size = patch_count * patches_per_paint
+            position = ENTRY_HEADER.size
+            header_offsets = read_uint32_table(entry_map, position, table_size)
+            position += table_size * 4
+            target_offsets = read_uint32_table(entry_map, position, patches_per_paint)
+            position += patches_per_paint * 4
+            patch_sizes = read_uint32_table(entry_map, position, patches_per_paint)
+
+            pat = PatFile(path)
+            pat.attach(memoryview(entry_map)[data_offset:data_offset + size], header_offsets, target_offsets, patch_sizes,
+                       mapping=(entry_file, entry_map), cache_size=cache_size)
+        except BaseException:
+            # A damaged entry must not leave the entry file open or mapped
+            if entry_map is not None:
+                entry_map.close()
+            entry_file.close()
+            raise
+        pat.mark_synced()
+        return pat
+
+    def _store(self, entry_path, pat, stat):
+        tables = (
+            pack_uint32_table(pat.header_offsets) +
+            pack_uint32_table(pat.target_offsets) +
+            pack_uint32_table(pat.patch_sizes)
+        )
+        data_offset = ENTRY_HEADER.size + len(tables)
+        data_offset += (16 - data_offset % 16) % 16
+        header = ENTRY_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, stat.st_size, stat.st_mtime_ns, hashlib.sha256(pat.data).digest(),
+                                   pat.patch_count, pat.geometry_patches_per_color_patch, data_offset)
+
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(header)
+                f.write(tables)
+                f.write(b'\x00' * (data_offset - ENTRY_HEADER.size - len(tables)))
+                f.write(pat.data)
+            # Fails on Windows while another window still maps the old entry; that window keeps using it
+            os.replace(temp_path, entry_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        # Drop the least recently used entries until the cache fits in max_size
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".patc"):
+                entry_stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, filename))
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            total_size -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".patc"):
+                    os.remove(os.path.join(self.directory, filename))
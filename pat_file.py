@@ -0,0 +1,489 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+
+from instrument import logger, span, traced
+
+HEADER_SIZE = 32
+RECORD_HEADER_SIZE = 8
+
+def padded_patch_size(patch_size):
+    # Patch data is stored padded to the next factor of 4
+    return patch_size + (4 - patch_size % 4) % 4
+
+def read_uint32_table(data, offset, count):
+    table = array('I')
+    table.frombytes(bytes(data[offset:offset + count * 4]))
+    if sys.byteorder == 'big':
+        table.byteswap()
+    return table
+
+def pack_uint32_table(table):
+    table = array('I', table)
+    if sys.byteorder == 'big':
+        table.byteswap()
+    return table.tobytes()
+
+@traced("add colors", nbytes=len)
+def add_color_entries(data, count=1, template=-1):
+    # Append count copies of the template paint, building the new file in one buffer
+    color_count = int.from_bytes(data[16:18], 'little')
+    offset_count_per_color = int.from_bytes(data[18:20], 'little')
+    offset_start = HEADER_SIZE
+    data_start = offset_start + (color_count * offset_count_per_color * 4)
+
+    if count < 0:
+        raise ValueError("The number of colors to add can't be negative")
+    # The paint count is a 16-bit header field
+    if color_count + count > 0xFFFF:
+        raise ValueError(f"A pat holds at most 65535 paints, this one has {color_count}")
+    if template < 0:
+        template += color_count
+    if not 0 <= template < color_count:
+        raise IndexError("Template paint index out of range")
+
+    offsets = read_uint32_table(data, offset_start, color_count * offset_count_per_color)
+    if color_count == 1:
+        block_size = len(data) - offsets[0]
+    else:
+        block_size = offsets[offset_count_per_color] - offsets[0]
+    offset_chunk_size = offset_count_per_color * 4 * count
+
+    template_offsets = offsets[template * offset_count_per_color:(template + 1) * offset_count_per_color]
+    template_start = template_offsets[0]
+
+    new_offsets = array('I', (offset + offset_chunk_size for offset in offsets))
+    for i in range(count):
+        block_start = len(data) + offset_chunk_size + i * block_size
+        new_offsets.extend(offset - template_start + block_start for offset in template_offsets)
+
+    new_color_count = color_count + count
+    new_data = bytearray(len(data) + offset_chunk_size + count * block_size)
+    new_data[:offset_start] = data[:offset_start]
+    new_data[16:18] = new_color_count.to_bytes(2, 'little')
+
+    position = offset_start + len(new_offsets) * 4
+    new_data[offset_start:position] = pack_uint32_table(new_offsets)
+
+    source = memoryview(data)
+    new_data[position:position + len(data) - data_start] = source[data_start:]
+    position += len(data) - data_start
+
+    template_block = source[template_start:template_start + block_size]
+    for _ in range(count):
+        new_data[position:position + block_size] = template_block
+        position += block_size
+
+    return new_data
+
+def add_color_entry(data):
+    return add_color_entries(data, 1)
+
+def _per_paint(values, paint_count):
+    # One value for every paint, or a sequence with one value per paint
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        return [values] * paint_count
+    values = list(values)
+    if len(values) != paint_count:
+        raise ValueError(f"Expected one value per paint ({paint_count}), got {len(values)}")
+    return values
+
+@traced("relayout patches", nbytes=len)
+def relayout_patches(data, layout):
+    # Rewrite every paint with a new patch list in one pass over a preallocated buffer.
+    # Layout entries are an existing patch index, or (target_offset, patch_size, values) for a new patch.
+    paint_count, patches_per_paint = struct.unpack_from('<HH', data, 16)
+    offsets = read_uint32_table(data, HEADER_SIZE, paint_count * patches_per_paint)
+
+    records = []
+    for entry in layout:
+        if isinstance(entry, int):
+            if not 0 <= entry < patches_per_paint:
+                raise IndexError(f"Patch index {entry} out of range")
+            target_offset, patch_size = struct.unpack_from('<II', data, offsets[entry])
+            records.append((target_offset, patch_size, entry))
+        else:
+            target_offset, patch_size, values = entry
+            values = _per_paint(values, paint_count)
+            if any(len(value) > padded_patch_size(patch_size) for value in values):
+                raise ValueError(f"Values for target offset {target_offset:#x} are longer than the patch")
+            records.append((target_offset, patch_size, values))
+    if len(records) > 0xFFFF:
+        raise ValueError("Too many patches per paint")
+
+    paint_size = sum(RECORD_HEADER_SIZE + padded_patch_size(patch_size) for _, patch_size, _ in records)
+    data_start = HEADER_SIZE + paint_count * len(records) * 4
+    new_data = bytearray(data_start + paint_count * paint_size)
+    new_data[:HEADER_SIZE] = data[:HEADER_SIZE]
+    new_data[18:20] = len(records).to_bytes(2, 'little')
+
+    source = memoryview(data)
+    new_offsets = array('I')
+    position = data_start
+    for paint_index in range(paint_count):
+        for target_offset, patch_size, values in records:
+            new_offsets.append(position)
+            record_size = RECORD_HEADER_SIZE + padded_patch_size(patch_size)
+            if isinstance(values, int):
+                old_offset = offsets[paint_index * patches_per_paint + values]
+                new_data[position:position + record_size] = source[old_offset:old_offset + record_size]
+            else:
+                struct.pack_into('<II', new_data, position, target_offset, patch_size)
+                value = values[paint_index]
+                new_data[position + RECORD_HEADER_SIZE:position + RECORD_HEADER_SIZE + len(value)] = value
+            position += record_size
+    new_data[HEADER_SIZE:data_start] = pack_uint32_table(new_offsets)
+    return new_data
+
+class ColorView:
+    # (N, 4) RGBA view over one patch of the file buffer, no per-color copies
+    def __init__(self, pat_file, start, count):
+        self.pat_file = pat_file
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def _position(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("color index out of range")
+        return self.start + index * 4
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        position = self._position(index)
+        return tuple(self.pat_file.data[position:position + 4])
+
+    def __setitem__(self, index, color):
+        position = self._position(index)
+        if len(color) != 4:
+            raise ValueError("Colors must have 4 components (RGBA)")
+        self.pat_file.data[position:position + 4] = bytes(color)
+        self.pat_file.mark_dirty(position, position + 4)
+
+    def __iter__(self):
+        data = self.pat_file.data
+        for position in range(self.start, self.start + self.count * 4, 4):
+            yield tuple(data[position:position + 4])
+
+    def tobytes(self):
+        return bytes(self.pat_file.data[self.start:self.start + self.count * 4])
+
+class LazyPaints:
+    # Decodes paints on first access and keeps the most recent ones around
+    def __init__(self, pat_file, cache_size=8):
+        self.pat_file = pat_file
+        self.cache_size = cache_size
+        self.decoded = OrderedDict()
+
+    def __len__(self):
+        return self.pat_file.patch_count
+
+    def __getitem__(self, paint_index):
+        if isinstance(paint_index, slice):
+            return [self[i] for i in range(*paint_index.indices(len(self)))]
+        if paint_index < 0:
+            paint_index += len(self)
+        if not 0 <= paint_index < len(self):
+            raise IndexError("paint index out of range")
+
+        paint = self.decoded.get(paint_index)
+        if paint is None:
+            paint = self.pat_file._decode_paint(paint_index)
+            self.decoded[paint_index] = paint
+            # Colors live in the file buffer, so dropping a decoded paint loses nothing
+            while len(self.decoded) > self.cache_size:
+                self.decoded.popitem(last=False)
+        else:
+            self.decoded.move_to_end(paint_index)
+        return paint
+
+    def __iter__(self):
+        for paint_index in range(len(self)):
+            yield self[paint_index]
+
+class PatFile:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.magic = b""
+        self.patch_count = 0
+        self.geometry_patches_per_color_patch = 0
+        self.data = bytearray()
+        # Offset table and per-patch layout, shared by every paint
+        self.header_offsets = array('I')
+        self.target_offsets = array('I')
+        self.patch_sizes = array('I')
+        self.patches = []
+        self._file = None
+        self._mmap = None
+        # Byte ranges changed since the file on disk was last in sync with the buffer
+        self.dirty_ranges = []
+        self._synced = None
+
+    def read(self, lazy=False, cache_size=8):
+        # Lazy mode maps the file copy-on-write and decodes paints on demand
+        if lazy and os.path.getsize(self.filename) > 0:
+            self._file = open(self.filename, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_COPY)
+            try:
+                self.load(self._mmap, lazy=True, cache_size=cache_size)
+            except Exception:
+                self.close()
+                raise
+        else:
+            with open(self.filename, 'rb') as f:
+                self.load(bytearray(f.read()))
+        self.mark_synced()
+
+    def close(self):
+        self.patches = []
+        if self._mmap is not None:
+            if isinstance(self.data, memoryview):
+                self.data.release()
+            self._mmap.close()
+            self._mmap = None
+            self.data = bytearray()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _detach(self):
+        # Copy the mapped file into memory so the file itself can be rewritten
+        data = bytearray(self.data)
+        patches = self.patches
+        self.close()
+        self.data = data
+        self.patches = patches
+
+    def load(self, data, lazy=False, cache_size=8):
+        self.data = data
+        with span("header parse", HEADER_SIZE):
+            self.magic = bytes(data[:4])
+            if self.magic != b'Pat0':
+                raise ValueError("Not a valid .pat file")
+
+            self.patch_count, self.geometry_patches_per_color_patch = struct.unpack_from('<HH', data, 16)
+            logger.debug("Magic: %s, Patch Count: %d, Geometry Patches per Color Patch: %d",
+                         self.magic, self.patch_count, self.geometry_patches_per_color_patch)
+
+        table_size = self.patch_count * self.geometry_patches_per_color_patch
+        with span("offset table", table_size * 4):
+            if HEADER_SIZE + table_size * 4 > len(data):
+                raise ValueError("Offset table runs past the end of the file")
+            self.header_offsets = read_uint32_table(data, HEADER_SIZE, table_size)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Header Offsets: %s", list(self.header_offsets))
+
+            # The first paint defines the patch layout for all of them
+            self.target_offsets = array('I')
+            self.patch_sizes = array('I')
+            if self.patch_count:
+                for offset in self.header_offsets[:self.geometry_patches_per_color_patch]:
+                    target_offset, patch_size = self._read_record_header(offset)
+                    self.target_offsets.append(target_offset)
+                    self.patch_sizes.append(patch_size)
+
+        self._init_paints(lazy, cache_size)
+
+    def attach(self, data, header_offsets, target_offsets, patch_sizes, mapping=None, lazy=True, cache_size=8):
+        # Take tables parsed earlier (e.g. from the pat cache) instead of parsing them again
+        if mapping is not None:
+            self._file, self._mmap = mapping
+        self.data = data
+        self.magic = bytes(data[:4])
+        self.patch_count, self.geometry_patches_per_color_patch = struct.unpack_from('<HH', data, 16)
+        self.header_offsets = header_offsets
+        self.target_offsets = target_offsets
+        self.patch_sizes = patch_sizes
+        self._init_paints(lazy, cache_size)
+
+    def _init_paints(self, lazy, cache_size):
+        if lazy:
+            self.patches = LazyPaints(self, cache_size)
+        else:
+            self.patches = [self._decode_paint(paint_index) for paint_index in range(self.patch_count)]
+
+    def _read_record_header(self, offset):
+        if offset + RECORD_HEADER_SIZE > len(self.data):
+            raise ValueError(f"Patch offset {offset} runs past the end of the file")
+        return struct.unpack_from('<II', self.data, offset)
+
+    def _decode_paint(self, paint_index):
+        patches_per_paint = self.geometry_patches_per_color_patch
+        header_offsets = self.header_offsets[paint_index * patches_per_paint:(paint_index + 1) * patches_per_paint]
+
+        with span("patch decode", self.colors_per_paint() * 4 + patches_per_paint * RECORD_HEADER_SIZE):
+            paint_data = []
+            for patch_index, offset in enumerate(header_offsets):
+                target_offset, patch_size = self._read_record_header(offset)
+                if target_offset != self.target_offsets[patch_index] or patch_size != self.patch_sizes[patch_index]:
+                    raise ValueError(f"Paint {paint_index} patch {patch_index} does not match the patch layout of paint 0")
+
+                trunc_patch_size = padded_patch_size(patch_size)
+                start = offset + RECORD_HEADER_SIZE
+                if start + trunc_patch_size > len(self.data):
+                    raise ValueError(f"Paint {paint_index} patch {patch_index} runs past the end of the file")
+
+                paint_data.append({
+                    'target_offset': target_offset,
+                    'patch_size': trunc_patch_size,
+                    'colors': ColorView(self, start, trunc_patch_size // 4),
+                    'actual_patch_size': patch_size
+                })
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Paint %d Patch %d: Target Offset: %d, Patch Size: %d, Colors: %s",
+                                 paint_index, patch_index, target_offset, patch_size, list(paint_data[-1]['colors']))
+
+        return {
+            'header_offsets': list(header_offsets),
+            'paint_data': paint_data
+        }
+
+    def paint_ranges(self, paint_index):
+        # (start, end) buffer positions of the color bytes of each patch in a paint
+        patches_per_paint = self.geometry_patches_per_color_patch
+        first = paint_index * patches_per_paint
+        ranges = []
+        for offset, patch_size in zip(self.header_offsets[first:first + patches_per_paint], self.patch_sizes):
+            start = offset + RECORD_HEADER_SIZE
+            ranges.append((start, start + padded_patch_size(patch_size)))
+        return ranges
+
+    def data_size(self):
+        # End of the last patch record; anything after it is padding
+        if not self.patch_count:
+            return HEADER_SIZE
+        return self.paint_ranges(self.patch_count - 1)[-1][1]
+
+    def colors_per_paint(self):
+        return sum(padded_patch_size(patch_size) for patch_size in self.patch_sizes) // 4
+
+    def paint_bytes(self, paint_index):
+        return b''.join(self.data[start:end] for start, end in self.paint_ranges(paint_index))
+
+    def set_paint_bytes(self, paint_index, colors):
+        if len(colors) != self.colors_per_paint() * 4:
+            raise ValueError("Color data does not match the number of colors in the paint")
+        colors = memoryview(colors)
+        position = 0
+        for start, end in self.paint_ranges(paint_index):
+            self.data[start:end] = colors[position:position + end - start]
+            self.mark_dirty(start, end)
+            position += end - start
+
+    def insert_patches(self, patches):
+        # (target_offset, patch_size, values) tuples, each placed in target offset order
+        layout = list(range(self.geometry_patches_per_color_patch))
+        target_offsets = list(self.target_offsets)
+        for patch in sorted(patches, key=lambda patch: patch[0]):
+            if patch[0] in target_offsets:
+                raise ValueError(f"Target offset {patch[0]:#x} already has a patch")
+            index = bisect.bisect_right(target_offsets, patch[0])
+            target_offsets.insert(index, patch[0])
+            layout.insert(index, patch)
+        self._relayout(layout)
+
+    def remove_patches(self, patch_indices):
+        removed = set(patch_indices)
+        if any(not 0 <= patch_index < self.geometry_patches_per_color_patch for patch_index in removed):
+            raise IndexError("Patch index out of range")
+        self._relayout([patch_index for patch_index in range(self.geometry_patches_per_color_patch) if patch_index not in removed])
+
+    def _relayout(self, layout):
+        lazy = isinstance(self.patches, LazyPaints)
+        cache_size = self.patches.cache_size if lazy else 8
+        data = relayout_patches(self.data, layout)
+        self.close()
+        self.load(data, lazy=lazy, cache_size=cache_size)
+
+    def set_patch_values(self, patch_index, values, paints=None):
+        # Stamp raw values (e.g. material presets) into one patch of many paints at once
+        if paints is None:
+            paints = range(self.patch_count)
+        paints = list(paints)
+        patches_per_paint = self.geometry_patches_per_color_patch
+        padded_size = padded_patch_size(self.patch_sizes[patch_index])
+        for paint_index, value in zip(paints, _per_paint(values, len(paints))):
+            if len(value) > padded_size:
+                raise ValueError(f"Value is longer than patch {patch_index}")
+            start = self.header_offsets[paint_index * patches_per_paint + patch_index] + RECORD_HEADER_SIZE
+            self.data[start:start + len(value)] = value
+            self.mark_dirty(start, start + len(value))
+
+    def mark_dirty(self, start, end):
+        self.dirty_ranges.append((start, end))
+
+    def _layout(self):
+        return (len(self.data), self.patch_count, self.geometry_patches_per_color_patch, self.header_offsets.tobytes())
+
+    def mark_synced(self, filename=None):
+        # The file on disk now matches the buffer, so later saves only need to write what changes
+        filename = filename or self.filename
+        stat = os.stat(filename)
+        self._synced = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, self._layout())
+        self.dirty_ranges = []
+
+    def _can_save_incrementally(self, filename):
+        if self._synced is None or os.path.abspath(filename) != self._synced[0]:
+            return False
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        # Same file, untouched since we last synced, and the same layout of patches
+        return (stat.st_size, stat.st_mtime_ns, self._layout()) == self._synced[1:]
+
+    def _merged_dirty_ranges(self):
+        merged = []
+        for start, end in sorted(self.dirty_ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    def save(self, filename):
+        if self._can_save_incrementally(filename):
+            self._save_dirty_ranges(filename)
+            return
+
+        # Header counts are the only fields kept outside the buffer
+        struct.pack_into('<HH', self.data, 16, self.patch_count, self.geometry_patches_per_color_patch)
+        if self._mmap is not None and os.path.abspath(filename) == os.path.abspath(self.filename):
+            self._detach()
+        try:
+            with span("pat save", len(self.data)), open(filename, 'wb') as f:
+                f.write(self.data)
+        except IOError as e:
+            raise IOError(f"Failed to save file: {e}")
+        self.mark_synced(filename)
+
+    def _save_dirty_ranges(self, filename):
+        # Write only the changed colors back at their offsets in the file
+        ranges = self._merged_dirty_ranges()
+        data = memoryview(self.data)
+        try:
+            with span("pat save (dirty ranges)", sum(end - start for start, end in ranges)), open(filename, 'r+b') as f:
+                for start, end in ranges:
+                    if hasattr(os, 'pwrite'):
+                        os.pwrite(f.fileno(), data[start:end], start)
+                    else:
+                        f.seek(start)
+                        f.write(data[start:end])
+        except IOError as e:
+            raise IOError(f"Failed to save file: {e}")
+        finally:
+            data.release()
+        self.mark_synced(filename)
+
+    def get_patches(self):
+        return self.patches
@@ -0,0 +1,60 @@
+import argparse
+import sys
+
+import instrument
+from pat_file import PatFile
+
+def parse_target(text):
+    return int(text, 0)
+
+def parse_paints(text, paint_count):
+    paints = []
+    for paint_index in text.split(","):
+        paint_index = int(paint_index)
+        if paint_index < 0:
+            paint_index += paint_count
+        paints.append(paint_index)
+    return paints
+
+def patch_index(pat_file, target_offset):
+    for index, offset in enumerate(pat_file.target_offsets):
+        if offset == target_offset:
+            return index
+    raise ValueError(f"No patch with target offset {target_offset:#x}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add, remove or set geometry patches in every paint of a pat.")
+    parser.add_argument("pat", help=".pat file")
+    parser.add_argument("-o", "--output", required=True, help="output .pat file")
+    parser.add_argument("--remove", type=parse_target, action="append", default=[], metavar="TARGET",
+                        help="remove the patch with this target offset, e.g. 0x392")
+    parser.add_argument("--add", action="append", default=[], metavar="TARGET:SIZE:HEX",
+                        help="add a patch to every paint, e.g. 0x362:2:803f")
+    parser.add_argument("--set", action="append", default=[], metavar="TARGET:HEX[:PAINTS]",
+                        help="write a value into a patch of the given paints (comma separated, default all), e.g. 0x392:8041:1,3")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    pat = PatFile(args.pat)
+    pat.read()
+    if args.remove:
+        pat.remove_patches([patch_index(pat, target_offset) for target_offset in args.remove])
+    if args.add:
+        patches = []
+        for spec in args.add:
+            target_offset, patch_size, value = spec.split(":")
+            patches.append((parse_target(target_offset), int(patch_size, 0), bytes.fromhex(value)))
+        pat.insert_patches(patches)
+    for spec in args.set:
+        target_offset, value, *paints = spec.split(":")
+        paints = parse_paints(paints[0], pat.patch_count) if paints else None
+        pat.set_patch_values(patch_index(pat, parse_target(target_offset)), bytes.fromhex(value), paints)
+
+    pat.save(args.output)
+    print(f"{args.output}: {pat.patch_count} paints, {pat.geometry_patches_per_color_patch} patches per paint")
+    instrument.finish(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
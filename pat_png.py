@@ -0,0 +1,57 @@
+import os
+
+from PIL import Image
+
+from instrument import span
+
+def paint_image(pat_file, paint_index):
+    return Image.frombytes("RGBA", (pat_file.colors_per_paint(), 1), pat_file.paint_bytes(paint_index))
+
+def atlas_image(pat_file):
+    # One row per paint, one column per color
+    colors = b''.join(pat_file.paint_bytes(paint_index) for paint_index in range(pat_file.patch_count))
+    return Image.frombytes("RGBA", (pat_file.colors_per_paint(), pat_file.patch_count), colors)
+
+def _rgba_bytes(image, current_colors):
+    # Images without alpha keep the opacity values already in the paints
+    if "A" not in image.getbands():
+        alpha = Image.frombytes("RGBA", image.size, current_colors()).getchannel("A")
+        image = image.convert("RGB")
+        image.putalpha(alpha)
+    return image.convert("RGBA").tobytes()
+
+def export_paint_png(pat_file, paint_index, path):
+    with span("png encode", pat_file.colors_per_paint() * 4):
+        paint_image(pat_file, paint_index).save(path)
+
+def export_paint_pngs(pat_file, folder, prefix="paint", progress=None):
+    # One PNG per paint; progress(done, total) is called after each one and may raise to stop early
+    paths = []
+    for paint_index in range(pat_file.patch_count):
+        path = os.path.join(folder, f"{prefix}_{paint_index}.png")
+        export_paint_png(pat_file, paint_index, path)
+        paths.append(path)
+        if progress is not None:
+            progress(paint_index + 1, pat_file.patch_count)
+    return paths
+
+def import_paint_png(pat_file, paint_index, path):
+    with span("png decode", pat_file.colors_per_paint() * 4), Image.open(path) as png_image:
+        if png_image.width != pat_file.colors_per_paint():
+            raise ValueError("PNG width does not match number of colors in the current paint")
+        row = png_image.crop((0, 0, png_image.width, 1))
+        pat_file.set_paint_bytes(paint_index, _rgba_bytes(row, lambda: pat_file.paint_bytes(paint_index)))
+
+def export_atlas(pat_file, path):
+    with span("png encode", pat_file.colors_per_paint() * 4 * pat_file.patch_count):
+        atlas_image(pat_file).save(path)
+
+def import_atlas(pat_file, path):
+    with span("png decode", pat_file.colors_per_paint() * 4 * pat_file.patch_count), Image.open(path) as png_image:
+        if png_image.size != (pat_file.colors_per_paint(), pat_file.patch_count):
+            raise ValueError("Atlas size does not match the colors and paints in this file")
+        colors = memoryview(_rgba_bytes(png_image, lambda: atlas_image(pat_file).tobytes()))
+
+    row_size = pat_file.colors_per_paint() * 4
+    for paint_index in range(pat_file.patch_count):
+        pat_file.set_paint_bytes(paint_index, colors[paint_index * row_size:(paint_index + 1) * row_size])
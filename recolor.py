@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops
+
+import instrument
+from car4 import extract_offsets, extract_asset, write_model
+from instrument import span
+from pat_file import PatFile, padded_patch_size
+from pat_png import paint_image
+
+RECIPE_VERSION = 1
+# Target offsets of the material patches (gloss/pearl values) from Examples/mits0006/info.txt:
+# the first 12 pixels of the menu pat and the first 10 of the lod/open pat.
+# Recipes can list their own in the mask's "exclude"
+MATERIAL_TARGET_OFFSETS = (
+    0x362, 0x366, 0x36A, 0x372, 0x376, 0x37A, 0x392, 0x3E2, 0x413, 0x417, 0x41B, 0x432,
+    0x232, 0x502, 0x520, 0x552
+)
+
+def color_mask(pat_file, exclude=MATERIAL_TARGET_OFFSETS):
+    # Every color except those of the patches at the excluded target offsets
+    exclude = set(exclude)
+    mask = bytearray()
+    for target_offset, patch_size in zip(pat_file.target_offsets, pat_file.patch_sizes):
+        mask += (b'\x00' if target_offset in exclude else b'\xff') * (padded_patch_size(patch_size) // 4)
+    return Image.frombytes("L", (pat_file.colors_per_paint(), 1), bytes(mask))
+
+def paint_mask(pat_file, paints=None, threshold=0, exclude=MATERIAL_TARGET_OFFSETS):
+    # Colors that differ between paints are the paint-relevant ones
+    if paints is None:
+        paints = range(pat_file.patch_count)
+    images = [paint_image(pat_file, paint_index).convert("RGB") for paint_index in paints]
+    if len(images) < 2:
+        return color_mask(pat_file, exclude)
+
+    difference = Image.new("RGB", images[0].size)
+    for image in images[1:]:
+        difference = ImageChops.lighter(difference, ImageChops.difference(images[0], image))
+    red, green, blue = difference.split()
+    difference = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    return ImageChops.multiply(difference.point(lambda value: 255 if value > threshold else 0), color_mask(pat_file, exclude))
+
+def key_color(image, mask):
+    # Brightest, most saturated and most opaque masked pixel, the input white point for levels
+    hue, saturation, value = image.convert("RGB").convert("HSV").split()
+    score = ImageChops.multiply(ImageChops.multiply(saturation, value), image.getchannel("A"))
+    score = ImageChops.multiply(score, mask)
+    best = score.getextrema()[1]
+    if best == 0:
+        # Grey or fully transparent paints, fall back to the brightest pixel
+        score = ImageChops.multiply(value, mask)
+        best = score.getextrema()[1]
+    index = score.tobytes().find(bytes([best]))
+    return image.getpixel((index, 0))[:3]
+
+def levels_lut(input_rgb, output_rgb):
+    lut = []
+    for input_value, output_value in zip(input_rgb, output_rgb):
+        if input_value == 0:
+            lut.extend([output_value] * 256)
+        else:
+            lut.extend(min(255, round(value * output_value / input_value)) for value in range(256))
+    # Opacity is left alone
+    lut.extend(range(256))
+    return lut
+
+def hsv_lut(hue_shift=0, saturation=1.0, value=1.0):
+    # hue_shift is in degrees, saturation and value are scale factors
+    shift = round(hue_shift * 256 / 360)
+    lut = [(level + shift) % 256 for level in range(256)]
+    lut.extend(min(255, round(level * saturation)) for level in range(256))
+    lut.extend(min(255, round(level * value)) for level in range(256))
+    return lut
+
+def adjust_hsv(image, hsv):
+    adjusted = image.convert("RGB").convert("HSV").point(hsv_lut(*hsv)).convert("RGB")
+    adjusted.putalpha(image.getchannel("A"))
+    return adjusted
+
+def recolor_image(image, mask, target_rgb=None, input_rgb=None, hsv=None):
+    # Levels onto target_rgb first, then the hue/saturation/value adjustment; either may be left out
+    recolored = image
+    if target_rgb is not None:
+        if input_rgb is None:
+            input_rgb = key_color(image, mask)
+        recolored = recolored.point(levels_lut(input_rgb, target_rgb))
+    if hsv is not None and tuple(hsv) != (0, 1.0, 1.0):
+        recolored = adjust_hsv(recolored, hsv)
+    return Image.composite(recolored, image, mask), input_rgb
+
+def recolor_paint(pat_file, target_rgb, source=0, dest=None, mask=None, input_rgb=None, hsv=None):
+    # Map the masked colors of the source paint onto target_rgb and write them into dest
+    if mask is None:
+        mask = paint_mask(pat_file)
+    if dest is None:
+        dest = source
+    with span("recolor", pat_file.colors_per_paint() * 4):
+        image, input_rgb = recolor_image(paint_image(pat_file, source), mask, target_rgb, input_rgb, hsv)
+        pat_file.set_paint_bytes(dest, image.tobytes())
+    return input_rgb
+
+def make_recipe(target_rgb, source=0, dest=None, mask_paints=None, threshold=0, input_rgb=None, hsv=None, mask_rule="diff",
+                exclude=MATERIAL_TARGET_OFFSETS):
+    # Paint indices may be negative, so the same recipe fits pats with different paint counts
+    return {
+        "version": RECIPE_VERSION,
+        "source_paint": source,
+        "dest_paint": source if dest is None else dest,
+        "mask": {"rule": mask_rule, "paints": mask_paints, "threshold": threshold, "exclude": list(exclude)},
+        "mapping": {
+            "type": "levels",
+            "input": None if input_rgb is None else list(input_rgb),
+            "output": None if target_rgb is None else list(target_rgb),
+            "hsv": None if hsv is None else list(hsv)
+        }
+    }
+
+def save_recipe(recipe, path):
+    with open(path, "w") as f:
+        json.dump(recipe, f, indent=2)
+
+def load_recipe(path):
+    with open(path) as f:
+        recipe = json.load(f)
+    if recipe.get("version") != RECIPE_VERSION:
+        raise ValueError(f"Unsupported recipe version: {recipe.get('version')}")
+    return recipe
+
+def _paint_index(pat_file, paint_index):
+    if paint_index < 0:
+        paint_index += pat_file.patch_count
+    if not 0 <= paint_index < pat_file.patch_count:
+        raise IndexError(f"Paint index {paint_index} out of range")
+    return paint_index
+
+def recipe_mask(pat_file, mask_rule):
+    # Recipes without an exclude list skip the known material patches
+    exclude = mask_rule.get("exclude", MATERIAL_TARGET_OFFSETS)
+    if mask_rule["rule"] == "all":
+        return color_mask(pat_file, exclude)
+    if mask_rule["rule"] == "diff":
+        paints = mask_rule.get("paints")
+        if paints is not None:
+            paints = [_paint_index(pat_file, paint_index) for paint_index in paints]
+        return paint_mask(pat_file, paints, mask_rule.get("threshold", 0), exclude)
+    raise ValueError(f"Unknown mask rule: {mask_rule['rule']}")
+
+def apply_recipe(pat_file, recipe):
+    mask = recipe_mask(pat_file, recipe["mask"])
+
+    mapping = recipe["mapping"]
+    if mapping["type"] != "levels":
+        raise ValueError(f"Unknown color mapping: {mapping['type']}")
+    input_rgb = mapping.get("input")
+    output_rgb = mapping.get("output")
+    return recolor_paint(
+        pat_file,
+        None if output_rgb is None else tuple(output_rgb),
+        source=_paint_index(pat_file, recipe["source_paint"]),
+        dest=_paint_index(pat_file, recipe["dest_paint"]),
+        mask=mask,
+        input_rgb=None if input_rgb is None else tuple(input_rgb),
+        hsv=mapping.get("hsv")
+    )
+
+def apply_recipes_to_file(path, recipes, output_path, asset_name="MainModelColorPatch"):
+    # Works on plain .pat files and on the color patch inside a CAR4 model
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data[:4] == b'Pat0':
+        pat = PatFile()
+        pat.load(bytearray(data))
+        for recipe in recipes:
+            apply_recipe(pat, recipe)
+        pat.save(output_path)
+        return output_path
+
+    offsets = extract_offsets(data)
+    asset_data = extract_asset(data, offsets, asset_name)
+    if asset_data is None:
+        raise ValueError(f"{path} has no {asset_name}")
+    pat = PatFile()
+    pat.load(bytearray(asset_data))
+    for recipe in recipes:
+        apply_recipe(pat, recipe)
+    del data
+    write_model(path, {asset_name: pat.data}, output_path)
+    return output_path
+
+def _apply_worker(path, recipes, output_path, asset_name, log_level):
+    # Runs in a worker process; timings go back to the parent with the result
+    instrument.configure_logging(log_level)
+    instrument.reset()
+    output_path = apply_recipes_to_file(path, recipes, output_path, asset_name)
+    return output_path, instrument.snapshot()
+
+def find_inputs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(".pat"):
+                        yield os.path.join(folder, filename)
+        else:
+            yield path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply recolor recipes to pat files and menu models.")
+    parser.add_argument("recipe", nargs="+", help="recipe .json files, applied in order")
+    parser.add_argument("-i", "--input", nargs="+", required=True, help="pat files, CAR4 models, or folders of pat files")
+    parser.add_argument("-o", "--output", required=True, help="output folder")
+    parser.add_argument("--asset", default="MainModelColorPatch", help="color patch to edit inside CAR4 models")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    recipes = [load_recipe(path) for path in args.recipe]
+    os.makedirs(args.output, exist_ok=True)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {}
+        for path in find_inputs(args.input):
+            output_path = os.path.join(args.output, os.path.basename(path))
+            futures[executor.submit(_apply_worker, path, recipes, output_path, args.asset, args.log_level)] = path
+        for future, path in futures.items():
+            try:
+                output_path, timings = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{path}: failed: {e}", file=sys.stderr)
+                continue
+            instrument.merge(timings)
+            print(f"{path}: wrote {output_path}")
+
+    instrument.finish(args)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+from car4 import MAGIC, HEADER_SIZE as CAR4_HEADER_SIZE, ASSET_NAMES, extract_offsets, find_next_offset
+from extract_all import COLOR_PATCH_ASSETS
+from instrument import span
+from pat_file import HEADER_SIZE, RECORD_HEADER_SIZE, padded_patch_size, read_uint32_table
+
+PAT_MAGIC = b'Pat0'
+# Problems listed per rule are capped so a badly broken file doesn't flood the report
+MAX_PROBLEMS_PER_RULE = 20
+
+class Report:
+    def __init__(self):
+        self.problems = []
+        self.counts = {}
+
+    def add(self, rule, message):
+        self.counts[rule] = self.counts.get(rule, 0) + 1
+        if self.counts[rule] <= MAX_PROBLEMS_PER_RULE:
+            self.problems.append({"rule": rule, "message": message})
+
+def validate_pat(data, report=None, where=""):
+    # Checks the offset table, record placement and the shared patch layout of a Pat0 buffer
+    report = report if report is not None else Report()
+    if bytes(data[:4]) != PAT_MAGIC:
+        report.add("pat-magic", f"{where}not a Pat0 file")
+        return report
+    if len(data) < HEADER_SIZE:
+        report.add("offset-table", f"{where}file is shorter than the header")
+        return report
+
+    paint_count, patches_per_paint = struct.unpack_from('<HH', data, 16)
+    table_end = HEADER_SIZE + paint_count * patches_per_paint * 4
+    if table_end > len(data):
+        report.add("offset-table", f"{where}offset table ends at {table_end}, past the end of the file ({len(data)})")
+        return report
+    offsets = read_uint32_table(data, HEADER_SIZE, paint_count * patches_per_paint)
+
+    records = []
+    layout = None
+    for paint_index in range(paint_count):
+        paint_layout = []
+        for patch_index in range(patches_per_paint):
+            offset = offsets[paint_index * patches_per_paint + patch_index]
+            if offset < table_end or offset + RECORD_HEADER_SIZE > len(data):
+                report.add("offset-range", f"{where}paint {paint_index} patch {patch_index}: offset {offset} is outside {table_end}-{len(data)}")
+                paint_layout.append(None)
+                continue
+            if offset % 4:
+                report.add("padding", f"{where}paint {paint_index} patch {patch_index}: offset {offset} is not 4-byte aligned")
+            target_offset, patch_size = struct.unpack_from('<II', data, offset)
+            end = offset + RECORD_HEADER_SIZE + padded_patch_size(patch_size)
+            if end > len(data):
+                report.add("offset-range", f"{where}paint {paint_index} patch {patch_index}: record ends at {end}, past the end of the file")
+            records.append((offset, end, paint_index, patch_index))
+            paint_layout.append((target_offset, patch_size))
+
+        if layout is None:
+            layout = paint_layout
+        else:
+            # Records already reported as out of range are left out of the comparison
+            changed = [patch_index for patch_index, (a, b) in enumerate(zip(layout, paint_layout)) if a is not None and b is not None and a != b]
+            if changed:
+                report.add("layout", f"{where}paint {paint_index}: target offset/size differs from paint 0 at patches {changed[:10]}")
+
+    records.sort()
+    position = table_end
+    for offset, end, paint_index, patch_index in records:
+        if offset < position:
+            report.add("overlap", f"{where}paint {paint_index} patch {patch_index}: record at {offset} overlaps the previous one (ends at {position})")
+        elif offset > position:
+            report.add("padding", f"{where}paint {paint_index} patch {patch_index}: {offset - position} unused bytes before the record")
+        position = max(position, end)
+    if len(data) - position >= 16:
+        report.add("padding", f"{where}{len(data) - position} bytes after the last record")
+    return report
+
+def validate_car4(data, report=None):
+    # Header size and asset offsets, then the color patches inside
+    report = report if report is not None else Report()
+    if bytes(data[:4]) != MAGIC or len(data) < CAR4_HEADER_SIZE:
+        report.add("car4-magic", "not a CAR4 file")
+        return report
+    total_size = struct.unpack_from('<I', data, 8)[0]
+    if total_size != len(data):
+        report.add("car4-size", f"header says {total_size} bytes, the file has {len(data)}")
+
+    offsets = extract_offsets(data)
+    previous = None
+    for asset_name, offset in zip(ASSET_NAMES, offsets):
+        if offset == 0:
+            continue
+        if offset % 16:
+            report.add("car4-alignment", f"{asset_name} offset {offset} is not 16-byte aligned")
+        if offset < CAR4_HEADER_SIZE or offset >= len(data):
+            report.add("car4-offsets", f"{asset_name} offset {offset} is outside {CAR4_HEADER_SIZE}-{len(data)}")
+        elif previous is not None and offset <= previous:
+            report.add("car4-offsets", f"{asset_name} offset {offset} does not come after the previous asset ({previous})")
+        else:
+            previous = offset
+
+    for asset_name in COLOR_PATCH_ASSETS:
+        index = ASSET_NAMES.index(asset_name)
+        start = offsets[index]
+        if start and start < len(data):
+            end = min(find_next_offset(offsets, index, len(data)), len(data))
+            validate_pat(data[start:end], report, f"{asset_name}: ")
+    return report
+
+def validate_file(path):
+    # Runs in a worker process
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size == 0:
+            data = b''
+            mapping = None
+        else:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = memoryview(mapping)
+        try:
+            with span("validate", size):
+                magic = bytes(data[:4])
+                if magic == MAGIC:
+                    kind, report = "car4", validate_car4(data)
+                elif magic == PAT_MAGIC:
+                    kind, report = "pat", validate_pat(data)
+                else:
+                    kind, report = "unknown", Report()
+                    report.add("magic", "neither a Pat0 nor a CAR4 file")
+        finally:
+            if mapping is not None:
+                data.release()
+                mapping.close()
+    return {"path": path, "type": kind, "ok": not report.counts, "problems": report.problems, "counts": report.counts}
+
+def _validate_worker(path, log_level):
+    # Timings go back to the parent with the result
+    instrument.configure_logging(log_level)
+    instrument.reset()
+    result = validate_file(path)
+    return result, instrument.snapshot()
+
+def find_files(paths, all_files=False):
+    # Folders are searched for .pat files, or every file when models (which have no extension) are wanted
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if all_files or filename.lower().endswith(".pat"):
+                        yield os.path.join(folder, filename)
+        else:
+            yield path
+
+def validate_paths(paths, workers=None, all_files=False, log_level="WARNING"):
+    files = list(find_files(paths, all_files))
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result, timings in executor.map(_validate_worker, files, [log_level] * len(files), chunksize=16):
+            instrument.merge(timings)
+            results.append(result)
+    if all_files:
+        # Other files found while walking a folder are not errors
+        results = [result for result in results if result["type"] != "unknown" or result["path"] in paths]
+    return {
+        "files": results,
+        "checked": len(results),
+        "failed": sum(not result["ok"] for result in results)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check pat files and CAR4 models for structural problems.")
+    parser.add_argument("paths", nargs="+", help="files or folders to check")
+    parser.add_argument("--models", action="store_true", help="also check files without a .pat extension found in folders (CAR4 models)")
+    parser.add_argument("--report", help="write the report as JSON to this file ('-' for stdout)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    instrument.add_arguments(parser)
+    args = parser.parse_args(argv)
+    instrument.configure_logging(args.log_level)
+
+    report = validate_paths(args.paths, args.jobs, args.models, args.log_level)
+    if args.report == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        for result in report["files"]:
+            if not result["ok"]:
+                print(f"{result['path']}: {sum(result['counts'].values())} problems", file=sys.stderr)
+                for problem in result["problems"]:
+                    print(f"  [{problem['rule']}] {problem['message']}", file=sys.stderr)
+        print(f"{report['checked']} files checked, {report['failed']} failed")
+
+    instrument.finish(args)
+    return 1 if report["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import queue
+import threading
+import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import messagebox, ttk
+
+from instrument import logger
+
+POLL_MS = 50
+
+class Cancelled(Exception):
+    pass
+
+class Task:
+    # Handed to the background function, which reports progress through it and checks for cancellation
+    def __init__(self, events, title):
+        self.events = events
+        self.title = title
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def progress(self, done, total):
+        # Doubles as the cancellation point, raising inside the file operation so it can clean up
+        if self.cancel_event.is_set():
+            raise Cancelled()
+        self.events.put((self, "progress", (done, total)))
+
+class Worker:
+    # Runs file operations off the Tk thread; results and progress come back on the mainloop through after()
+    def __init__(self, widget, max_workers=1):
+        self.widget = widget
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.events = queue.Queue()
+        self.callbacks = {}
+
+    def submit(self, function, on_done=None, on_error=None, title="Working...", show_progress=True):
+        # function(task) runs in the background; on_done(result) and on_error(exception) run on the mainloop
+        task = Task(self.events, title)
+        window = ProgressWindow(self.widget, task) if show_progress else None
+        self.callbacks[task] = (on_done, on_error, window)
+        if len(self.callbacks) == 1:
+            self.widget.after(POLL_MS, self.poll)
+        self.executor.submit(self.run, task, function)
+        return task
+
+    def run(self, task, function):
+        try:
+            self.events.put((task, "done", function(task)))
+        except Cancelled:
+            self.events.put((task, "cancelled", None))
+        except Exception as e:
+            logger.exception("%s failed", task.title)
+            self.events.put((task, "error", e))
+
+    def poll(self):
+        try:
+            while True:
+                task, kind, value = self.events.get_nowait()
+                on_done, on_error, window = self.callbacks.get(task, (None, None, None))
+                if kind == "progress":
+                    if window is not None:
+                        window.update_progress(*value)
+                    continue
+                del self.callbacks[task]
+                if window is not None:
+                    window.close()
+                if kind == "done" and on_done is not None:
+                    on_done(value)
+                elif kind == "error":
+                    if on_error is not None:
+                        on_error(value)
+                    else:
+                        messagebox.showerror("Error", f"{task.title} failed: {value}", parent=self.widget)
+        except queue.Empty:
+            pass
+        finally:
+            # Keep polling even if a callback failed, other tasks may still be running
+            if self.callbacks and self.widget.winfo_exists():
+                self.widget.after(POLL_MS, self.poll)
+
+class ProgressWindow(tk.Toplevel):
+    # Keeps input away from the window that owns the task while it runs; the mainloop keeps drawing
+    def __init__(self, master, task):
+        super().__init__(master)
+        self.task = task
+        self.title(task.title)
+        self.geometry("300x100")
+        self.resizable(False, False)
+        self.transient(master.winfo_toplevel())
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+
+        self.label = ttk.Label(self, text=task.title)
+        self.label.pack(pady=5)
+        self.bar = ttk.Progressbar(self, mode="indeterminate", length=260)
+        self.bar.pack(pady=5)
+        self.bar.start()
+        self.cancel_button = ttk.Button(self, text="Cancel", command=self.cancel)
+        self.cancel_button.pack(pady=5)
+        self.after_idle(self.grab)
+
+    def grab(self):
+        if not self.winfo_exists():
+            return
+        try:
+            self.grab_set()
+        except tk.TclError:
+            # Not viewable yet
+            self.after(POLL_MS, self.grab)
+
+    def update_progress(self, done, total):
+        if self.bar["mode"] != "determinate":
+            self.bar.stop()
+            self.bar.configure(mode="determinate")
+        self.bar.configure(maximum=max(total, 1), value=done)
+
+    def cancel(self):
+        self.task.cancel()
+        self.cancel_button.configure(state=tk.DISABLED)
+        self.label.configure(text="Cancelling...")
+
+    def close(self):
+        self.grab_release()
+        self.destroy()
@@ -0,0 +1,82 @@
+from car4 import MAGIC, HEADER_SIZE, ASSET_NAMES, extract_offsets, read_assets, write_model
+from extract_all import COLOR_PATCH_ASSETS
+from instrument import logger
+from pat_file import PatFile, add_color_entries
+
+class CarModel:
+    # A menu model held in memory; every tool edits the same asset buffers and parsed pats,
+    # and the model file is only written again when it is saved
+    def __init__(self, path):
+        self.path = path
+        self.assets = {}
+        self.pats = {}
+        self.modified = set()
+        self.read_header()
+
+    def read_header(self):
+        with open(self.path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if header[:4] != MAGIC:
+            raise ValueError(f"{self.path} is not a model file")
+        self.offsets = extract_offsets(header)
+
+    def has_asset(self, asset_name):
+        return self.offsets[ASSET_NAMES.index(asset_name)] != 0
+
+    def color_patches(self):
+        return [asset_name for asset_name in COLOR_PATCH_ASSETS if self.has_asset(asset_name)]
+
+    def asset(self, asset_name):
+        if asset_name in self.pats:
+            return self.pats[asset_name].data
+        if asset_name not in self.assets:
+            self.assets.update(read_assets(self.path, [asset_name]))
+        return self.assets.get(asset_name)
+
+    def pat(self, asset_name):
+        if asset_name not in self.pats:
+            asset_data = self.asset(asset_name)
+            if asset_data is None:
+                raise ValueError(f"{self.path} has no {asset_name}")
+            pat = PatFile()
+            pat.load(bytearray(asset_data))
+            self.pats[asset_name] = pat
+            self.assets.pop(asset_name, None)
+        return self.pats[asset_name]
+
+    def add_colors(self, asset_name, count=1, template=-1):
+        # Adding colors changes the pat layout, so the pat is parsed again from the grown buffer
+        pat = self.pat(asset_name)
+        new_pat = PatFile()
+        new_pat.load(add_color_entries(pat.data[:pat.data_size()], count, template))
+        self.pats[asset_name] = new_pat
+        self.modified.add(asset_name)
+        return new_pat
+
+    def replace_asset(self, asset_name, data):
+        self.assets[asset_name] = bytes(data)
+        self.pats.pop(asset_name, None)
+        self.modified.add(asset_name)
+
+    def modified_assets(self):
+        asset_names = self.modified | {asset_name for asset_name, pat in self.pats.items() if pat.dirty_ranges}
+        return {asset_name: self.asset(asset_name) for asset_name in asset_names}
+
+    def is_modified(self):
+        return bool(self.modified_assets())
+
+    def export_asset(self, asset_name, path):
+        with open(path, "wb") as f:
+            f.write(self.asset(asset_name))
+
+    def save(self, output_path=None, progress=None):
+        # Unchanged assets are streamed from the original model file
+        output_path = output_path or self.path
+        new_assets = self.modified_assets()
+        logger.info("Saving %s with new %s", output_path, ", ".join(sorted(new_assets)) or "nothing")
+        write_model(self.path, new_assets, output_path, progress)
+        self.path = output_path
+        self.read_header()
+        self.modified.clear()
+        for pat in self.pats.values():
+            pat.dirty_ranges = []